@@ -0,0 +1,260 @@
+"""
+musou_kokaton.py の負荷試験ベンチマーク
+決まったシナリオを乱数のシードを固定してウィンドウなしで指定フレーム数だけ回し，
+フレームごとの処理時間とメモリ使用量をJSONに書き出す
+メモリはフレームごとに，シナリオ開始時から増えたPythonのメモリブロック数（sys.getallocatedblocks）を記録する
+--baselineで前回の結果を渡すと，遅くなったかメモリが増えたシナリオを報告して終了コード1を返す
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # ウィンドウを出さずに計測する
+import pygame as pg
+import musou_kokaton as mk
+
+MEM_SLACK = 1000  # メモリの比較で無視するブロック数の増加（GCのタイミングなどによるぶれ）
+
+
+def _keep_alive(game: mk.Game):
+    """
+    シナリオの途中でゲームが終わらないように，こうかとんと敵のHPを保つ
+    """
+    game.bird.hp = 100
+    for emy in game.emys:
+        emy.hp = 50
+
+
+def boss_bombs(n: int):
+    """
+    ボス1体と爆弾n個（減った分を毎フレーム補充する）
+    """
+    def scenario(game: mk.Game, frame: int) -> mk.Inputs:
+        _keep_alive(game)
+        emy = next(iter(game.emys))
+        if game.bomb_arr is not None:
+            k = n-len(game.bomb_arr)
+            if k > 0:
+                origins = [(random.randint(0, mk.WIDTH), random.randint(0, 200)) for _ in range(k)]
+                kinds = [random.randrange(len(mk.Bomb.colors)) for _ in range(k)]
+                game.bomb_arr.aim(origins, game.bird.rect.center, 5, kinds)
+        else:
+            for _ in range(n-len(game.bombs)):
+                bomb = game.pools[mk.Bomb].acquire(emy, game.bird)
+                if bomb is None:
+                    break
+                bomb.rect.center = random.randint(0, mk.WIDTH), random.randint(0, 200)
+                bomb.vx, bomb.vy = mk.calc_orientation(bomb.rect, game.bird.rect)  # 配列版と同じく置いた位置から狙う
+                bomb.speed = 5
+                game.spawn(game.bombs, bomb)
+        return mk.Inputs({pg.K_LEFT: frame//50%2 == 0, pg.K_RIGHT: frame//50%2 == 1})
+    return scenario
+
+
+def beam_fire(game: mk.Game, frame: int) -> mk.Inputs:
+    """
+    左右に動きながら毎フレーム通常ビームを撃ち続ける
+    """
+    _keep_alive(game)
+    return mk.Inputs({pg.K_LEFT: frame//100%2 == 0, pg.K_RIGHT: frame//100%2 == 1}, ("down", "up"))
+
+
+def charge_spam(game: mk.Game, frame: int) -> mk.Inputs:
+    """
+    60フレーム溜めてチャージショットを撃つのを繰り返す（画面外に出たチャージビームが残らないかも見る）
+    """
+    _keep_alive(game)
+    space = ("down",) if frame%61 == 0 else ("up",) if frame%61 == 60 else ()
+    return mk.Inputs({pg.K_UP: frame%40 == 0}, space)
+
+
+def heal_flood(n: int):
+    """
+    回復アイテムを毎フレームn個ずつ降らせる
+    """
+    def scenario(game: mk.Game, frame: int) -> mk.Inputs:
+        _keep_alive(game)
+        game.bird.hp = 10  # 回復アイテムを取り続けられるように
+        for _ in range(n):
+            game.spawn(game.healitems, mk.HealItem())
+        return mk.Inputs({pg.K_LEFT: frame//60%2 == 0, pg.K_RIGHT: frame//60%2 == 1})
+    return scenario
+
+
+def explosion_storm(n: int):
+    """
+    爆発エフェクトを毎フレームn個ずつ発生させる
+    """
+    def scenario(game: mk.Game, frame: int) -> mk.Inputs:
+        _keep_alive(game)
+        for _ in range(n):
+            center = random.randint(0, mk.WIDTH), random.randint(0, mk.HEIGHT)
+            game.effects.add(center, 50)
+        return mk.Inputs()
+    return scenario
+
+
+def minion_swarm(n: int):
+    """
+    上下に揺れながら横切る雑魚敵をn体に保ち，半分は画面外の遠くに置く（間引きの効果を見る）
+    """
+    def scenario(game: mk.Game, frame: int) -> mk.Inputs:
+        _keep_alive(game)
+        minions = [emy for emy in game.emys if isinstance(emy, mk.Minion)]
+        for i in range(n-len(minions)):
+            x = random.randint(0, mk.WIDTH) if i%2 == 0 else random.randint(3*mk.WIDTH, 4*mk.WIDTH)  # 奇数番目は遠く
+            game.spawn(game.emys, mk.Minion((x, random.randint(50, 300)), (random.choice((-2, 2)), 0), "sine",
+                                            fire="down", interval=120))
+        return mk.Inputs({pg.K_LEFT: frame//50%2 == 0, pg.K_RIGHT: frame//50%2 == 1}, ("down", "up") if frame%8 == 0 else ())
+    return scenario
+
+
+SCENARIOS = {
+    "boss_bombs_100": boss_bombs(100),
+    "boss_bombs_300": boss_bombs(300),
+    "beam_fire": beam_fire,
+    "charge_spam": charge_spam,
+    "heal_flood": heal_flood(3),
+    "explosion_storm": explosion_storm(5),
+    "minion_swarm": minion_swarm(100),
+}
+
+
+def percentile(vals: list[float], q: float) -> float:
+    """
+    ソート済みのリストからqパーセンタイルの値を返す
+    """
+    return vals[min(len(vals)-1, int(q*len(vals)))] if vals else 0.0
+
+
+def run_scenario(name: str, frames: int, seed: int, render: bool, soa: bool) -> dict:
+    """
+    シナリオを1つ回して結果を返す
+    引数1 name：SCENARIOSのシナリオ名
+    引数2 frames：回すフレーム数
+    引数3 seed：乱数のシード
+    引数4 render：Trueなら描画も含めて計測する
+    引数5 soa：Trueなら爆弾と通常ビームを配列版で扱う
+    戻り値：処理時間（ミリ秒）の統計やメモリ使用量などの辞書
+    """
+    random.seed(seed)
+    screen = pg.display.get_surface()
+    game = mk.Game(soa=soa, seed=seed)
+    scenario = SCENARIOS[name]
+    times = []
+    blocks = []  # フレームごとの，シナリオ開始時から増えたメモリブロック数
+    gc.collect()  # 前のシナリオのゴミを片付けてから数え始める
+    blocks0 = sys.getallocatedblocks()
+    max_counts: dict[str, int] = {}
+    for frame in range(frames):
+        t0 = time.perf_counter()
+        game.snapshot()
+        game.step(scenario(game, frame))
+        if render:
+            game.draw(screen)
+        times.append((time.perf_counter()-t0)*1000)
+        blocks.append(sys.getallocatedblocks()-blocks0)
+        for key, n in game.counts().items():
+            max_counts[key] = max(max_counts.get(key, 0), n)
+    total = sum(times)
+    ordered = sorted(times)
+    return {
+        "frames": frames,
+        "mean_ms": total/frames,
+        "p50_ms": percentile(ordered, 0.50),
+        "p95_ms": percentile(ordered, 0.95),
+        "p99_ms": percentile(ordered, 0.99),
+        "max_ms": ordered[-1],
+        "fps": frames/(total/1000) if total > 0 else float("inf"),
+        "alloc_blocks": blocks[-1],  # シナリオの前後で増えたメモリブロック数
+        "peak_blocks": max(blocks),  # シナリオ中に最も増えたときのメモリブロック数
+        "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,  # プロセス全体の最大（シナリオ間では比べられない）
+        "end_counts": game.counts(),
+        "max_counts": max_counts,
+        "pools": {cls.__name__: pool.stats() for cls, pool in game.pools.items()},
+        "effects": game.effects.stats(),
+        "frame_ms": times,
+        "frame_blocks": blocks,
+    }
+
+
+def config_diff(config: dict, baseline: dict) -> list[str]:
+    """
+    前回の結果と設定（フレーム数，シード，描画の有無，配列版か）が違う項目を返す
+    """
+    base = baseline.get("config", {})
+    return [f"{key} {base.get(key)!r} -> {config[key]!r}" for key in ("frames", "seed", "render", "soa")
+            if base.get(key) != config[key]]
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    前回の結果と比べ，平均かp95がtoleranceの割合を超えて遅くなったシナリオと，
+    メモリブロックの増加（最後と最大）がtoleranceの割合とMEM_SLACKを超えて増えたシナリオを返す
+    設定が違う結果とは比べられないので，ValueErrorを出す
+    """
+    if diff := config_diff(results["config"], baseline):
+        raise ValueError("前回の結果と設定が違うので比べられません："+"，".join(diff))
+    slower = []
+    for name, res in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base is None:
+            continue
+        for key in ("mean_ms", "p95_ms"):
+            if res[key] > base[key]*(1+tolerance):
+                slower.append(f"{name}: {key} {base[key]:.3f} -> {res[key]:.3f} ms")
+        for key in ("alloc_blocks", "peak_blocks"):
+            if key in base and res[key] > max(base[key], 0)*(1+tolerance)+MEM_SLACK:
+                slower.append(f"{name}: {key} {base[key]} -> {res[key]} blocks")
+    return slower
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="真！こうかとん無双の負荷試験")
+    parser.add_argument("--frames", type=int, default=600, help="シナリオごとのフレーム数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="回すシナリオ（省略時は全て）")
+    parser.add_argument("--no-render", action="store_true", help="描画を含めずに計測する")
+    parser.add_argument("--soa", action="store_true", help="爆弾と通常ビームを配列版で扱う（要NumPy）")
+    parser.add_argument("--out", default="bench.json", help="結果を書き出すJSONファイル")
+    parser.add_argument("--baseline", help="比較する前回の結果のJSONファイル")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="遅くなった（メモリが増えた）とみなす割合")
+    args = parser.parse_args()
+    if args.soa and mk.np is None:
+        parser.error("--soa にはNumPyが必要です")
+
+    config = {"frames": args.frames, "seed": args.seed, "render": not args.no_render, "soa": args.soa}
+    baseline = None
+    if args.baseline:  # 設定が違えば比べられないので，回す前に確かめる
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if diff := config_diff(config, baseline):
+            parser.error(f"{args.baseline} と設定が違うので比べられません："+"，".join(diff))
+
+    pg.init()
+    pg.display.set_mode((mk.WIDTH, mk.HEIGHT))
+    results = {"config": config, "scenarios": {}}
+    for name in args.scenario or SCENARIOS:
+        res = results["scenarios"][name] = run_scenario(name, args.frames, args.seed, not args.no_render, args.soa)
+        print(f"{name:<16} mean {res['mean_ms']:7.3f} ms  p95 {res['p95_ms']:7.3f} ms  "
+              f"p99 {res['p99_ms']:7.3f} ms  {res['fps']:8.1f} fps  peak {res['peak_blocks']:+6d} blocks  "
+              f"max {res['max_counts']}")
+    with open(args.out, "w") as f:
+        json.dump(results, f)
+    pg.quit()
+
+    if baseline is not None:
+        slower = compare(results, baseline, args.tolerance)
+        for line in slower:
+            print(f"REGRESSION {line}")
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
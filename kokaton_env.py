@@ -0,0 +1,283 @@
+"""
+真！こうかとん無双を強化学習用の環境（Gym形式のreset/step）として扱うモジュール
+ウィンドウなし・フレーム上限なしで回し，VecEnvで複数のゲームを別プロセスで並列に進める
+
+    env = KokatonEnv(seed=0)
+    obs, info = env.reset()
+    obs, reward, terminated, truncated, info = env.step([0, 1, 0, 1])
+
+行動は[左, 右, 上, スペース]の4つの0/1で，スペースは押しているかどうかを表す
+（押し始めと離した瞬間に，ゲームへ押した／離したイベントを送る）
+観測はこうかとん，ボス，近い爆弾と回復アイテムの状態を並べたfloat32の配列で，
+frame=(幅, 高さ)を指定すると縮小した画面（高さ×幅×3のuint8配列）との辞書になる
+報酬はスコアの増分＋hp_weight×HPの増減
+gymnasiumがあればgymnasium.Envを継承し，observation_spaceとaction_spaceも持つ（NumPyは必須）
+"""
+import multiprocessing as mp
+import os
+import random
+
+import numpy as np
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # ウィンドウを出さずに回す
+import pygame as pg
+import musou_kokaton as mk
+
+try:
+    import gymnasium as gym
+    from gymnasium import spaces
+except ImportError:  # gymnasiumが無くてもreset/stepはそのまま使える
+    gym = spaces = None
+
+
+class KokatonEnv(gym.Env if gym is not None else object):
+    """
+    1つのゲームをreset/stepで進める環境
+    """
+    metadata = {"render_modes": ["rgb_array"], "render_fps": mk.SIM_FPS}
+    n_bombs = 8  # 観測に入れる近い爆弾の数
+    n_obs = 11+4*n_bombs+3  # 観測ベクトルの長さ
+
+    def __init__(self, seed: int | None = None, frame: tuple[int, int] | None = None, frame_skip: int = 1,
+                 max_steps: int = 5000, hp_weight: float = 1.0, soa: bool = False):
+        """
+        引数1 seed：最初のゲームの乱数のシード（以降のresetのシードもここから決める）
+        引数2 frame：(幅, 高さ)を指定すると縮小した画面も観測に含める
+        引数3 frame_skip：1回のstepで同じ行動を続けるフレーム数
+        引数4 max_steps：この回数stepしたら打ち切る（truncated）
+        引数5 hp_weight：HPの増減にかける報酬の重み
+        引数6 soa：Trueなら爆弾と通常ビームを配列版で扱う
+        """
+        self.rng = random.Random(seed)
+        self.next_seed = seed
+        self.frame = frame
+        self.frame_skip = frame_skip
+        self.max_steps = max_steps
+        self.hp_weight = hp_weight
+        self.soa = soa
+        self.game: mk.Game | None = None
+        self.space = False  # 前のstepでスペースを押していたか
+        self.steps = 0
+        pg.init()
+        self.screen = pg.display.get_surface() or pg.display.set_mode((mk.WIDTH, mk.HEIGHT))
+        if spaces is not None:
+            self.action_space = spaces.MultiBinary(4)
+            vec = spaces.Box(-np.inf, np.inf, (__class__.n_obs,), np.float32)
+            if frame is None:
+                self.observation_space = vec
+            else:
+                img = spaces.Box(0, 255, (frame[1], frame[0], 3), np.uint8)
+                self.observation_space = spaces.Dict({"state": vec, "frame": img})
+
+    def reset(self, seed: int | None = None, options: dict | None = None):
+        """
+        新しいゲームを始める
+        引数1 seed：このゲームの乱数のシード（Noneなら環境の乱数から決める）
+        戻り値：(観測, 情報の辞書)
+        """
+        if seed is None:
+            seed = self.next_seed if self.next_seed is not None else self.rng.randrange(2**32)
+        self.next_seed = None
+        self.game = mk.Game(soa=self.soa, seed=seed)
+        self.space = False
+        self.steps = 0
+        return self.observe(), self.info()
+
+    def step(self, action):
+        """
+        行動を与えてframe_skipフレーム進める
+        引数 action：[左, 右, 上, スペース]の0/1
+        戻り値：(観測, 報酬, 終了したか, 打ち切ったか, 情報の辞書)
+        """
+        game = self.game
+        left, right, up, space = (bool(a) for a in action)
+        pressed = {pg.K_LEFT: left, pg.K_RIGHT: right, pg.K_UP: up}
+        score0, hp0 = game.score.value, game.bird.hp
+        status = game.state.state
+        for i in range(self.frame_skip):
+            events = ()
+            if i == 0 and space != self.space:  # スペースの押し始めと離した瞬間だけイベントを送る
+                events = ("down",) if space else ("up",)
+            status = game.step(mk.Inputs(pressed, events))
+            if status not in ("play", "hitstop"):
+                break
+        self.space = space
+        self.steps += 1
+        reward = (game.score.value-score0)+self.hp_weight*(game.bird.hp-hp0)
+        terminated = status not in ("play", "hitstop")
+        truncated = not terminated and self.steps >= self.max_steps
+        return self.observe(), float(reward), terminated, truncated, self.info()
+
+    def info(self) -> dict:
+        """
+        観測以外の情報（スコア，HP，状態，シード）
+        """
+        game = self.game
+        return {"score": game.score.value, "hp": game.bird.hp, "status": game.state.state, "seed": game.seed}
+
+    def observe(self):
+        """
+        今のゲームの状態から観測を作る
+        """
+        game = self.game
+        bird = game.bird
+        obs = np.zeros(__class__.n_obs, np.float32)
+        bx, by = bird.rect.center
+        obs[0:7] = (bx/mk.WIDTH, by/mk.HEIGHT, bird.hp/100, bird.dire[0], bird.dire[1],
+                    min(game.c_tmr, 60)/60 if game.judge else 0, game.state.invincible > 0)
+        for emy in game.emys:  # ボスは1体
+            obs[7:11] = (1, (emy.rect.centerx-bx)/mk.WIDTH, (emy.rect.centery-by)/mk.HEIGHT, emy.hp/50)
+            break
+
+        # 爆弾は近い順にn_bombs個，相対位置と速度を並べる
+        pos = [bomb.rect.center for bomb in game.bombs]
+        vel = [(bomb.speed*bomb.vx, bomb.speed*bomb.vy) for bomb in game.bombs]
+        if game.bomb_arr is not None and len(game.bomb_arr):
+            n = game.bomb_arr.n
+            pos = np.concatenate([np.reshape(pos, (-1, 2)), game.bomb_arr.pos[:n]])
+            vel = np.concatenate([np.reshape(vel, (-1, 2)), game.bomb_arr.vel[:n]])
+        if len(pos):
+            rel = (np.asarray(pos, np.float32)-(bx, by))/(mk.WIDTH, mk.HEIGHT)
+            vel = np.asarray(vel, np.float32)/15
+            near = np.argsort((rel*rel).sum(axis=1))[:__class__.n_bombs]
+            feats = np.hstack([rel[near], vel[near]])
+            obs[11:11+4*len(near)] = feats.ravel()
+
+        items = [(item.rect.centerx-bx, item.rect.centery-by) for item in game.healitems]
+        if items:
+            dx, dy = min(items, key=lambda d: d[0]*d[0]+d[1]*d[1])
+            obs[-3:] = (1, dx/mk.WIDTH, dy/mk.HEIGHT)
+
+        if self.frame is None:
+            return obs
+        return {"state": obs, "frame": self.render()}
+
+    def render(self) -> np.ndarray:
+        """
+        画面を描いて縮小し，高さ×幅×3のuint8配列で返す（frameを指定していなければ元の大きさ）
+        """
+        self.game.draw(self.screen)
+        surf = self.screen if self.frame is None else pg.transform.smoothscale(self.screen, self.frame)
+        return pg.surfarray.array3d(surf).transpose(1, 0, 2)
+
+    def close(self):
+        pg.quit()
+
+
+def _worker(conn, kwargs: dict):
+    """
+    子プロセスで環境を1つ持ち，親からのコマンドを処理し続ける
+    終了したゲームは自動でresetし，最後の観測と情報はinfoの"final_observation"と"final_info"に入れて返す
+    """
+    env = KokatonEnv(**kwargs)
+    try:
+        while True:
+            cmd, data = conn.recv()
+            if cmd == "step":
+                obs, reward, terminated, truncated, info = env.step(data)
+                if terminated or truncated:
+                    info = {"final_observation": obs, "final_info": info}
+                    obs, _ = env.reset()
+                conn.send((obs, reward, terminated, truncated, info))
+            elif cmd == "reset":
+                conn.send(env.reset(seed=data))
+            elif cmd == "close":
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env.close()
+        conn.close()
+
+
+def _stack(obs_list: list):
+    """
+    環境ごとの観測を先頭に環境の軸を足した配列（辞書ならキーごと）にまとめる
+    """
+    if isinstance(obs_list[0], dict):
+        return {key: np.stack([obs[key] for obs in obs_list]) for key in obs_list[0]}
+    return np.stack(obs_list)
+
+
+class VecEnv:
+    """
+    KokatonEnvを環境ごとに別プロセスで動かし，まとめてstepする
+    stepは全環境に行動を送ってから結果を待つので，各プロセスのゲームは並列に進む
+    """
+    def __init__(self, num_envs: int, seed: int = 0, start_method: str | None = None, **kwargs):
+        """
+        引数1 num_envs：環境（プロセス）の数
+        引数2 seed：i番目の環境の最初のシードをseed+iにする
+        引数3 start_method：multiprocessingの開始方法（Noneなら既定）
+        引数4 kwargs：KokatonEnvに渡す引数
+        """
+        ctx = mp.get_context(start_method)
+        self.num_envs = num_envs
+        self.conns = []
+        self.procs = []
+        for i in range(num_envs):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_worker, args=(child, {**kwargs, "seed": seed+i}), daemon=True)
+            proc.start()
+            child.close()
+            self.conns.append(parent)
+            self.procs.append(proc)
+
+    def reset(self, seed: int | None = None):
+        """
+        全環境をresetする
+        引数 seed：指定するとi番目の環境のシードをseed+iにする
+        戻り値：(まとめた観測, 情報の辞書のリスト)
+        """
+        for i, conn in enumerate(self.conns):
+            conn.send(("reset", None if seed is None else seed+i))
+        obs, infos = zip(*(conn.recv() for conn in self.conns))
+        return _stack(obs), list(infos)
+
+    def step(self, actions):
+        """
+        全環境を1stepずつ進める（終了した環境は自動でresetする）
+        引数 actions：環境数×4の行動
+        戻り値：(観測, 報酬, 終了したか, 打ち切ったか)の配列と情報の辞書のリスト
+        """
+        for conn, action in zip(self.conns, actions):
+            conn.send(("step", [int(a) for a in action]))
+        obs, rewards, terminated, truncated, infos = zip(*(conn.recv() for conn in self.conns))
+        return (_stack(obs), np.array(rewards, np.float32), np.array(terminated), np.array(truncated), list(infos))
+
+    def close(self):
+        """
+        子プロセスを終了させる
+        """
+        for conn in self.conns:
+            try:
+                conn.send(("close", None))
+            except (BrokenPipeError, EOFError):
+                pass
+        for proc in self.procs:
+            proc.join(timeout=5)
+        for conn in self.conns:
+            conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="ランダムな行動で環境を回し，1秒あたりのstep数を表示する")
+    parser.add_argument("--envs", type=int, default=os.cpu_count() or 1, help="並列に動かす環境の数")
+    parser.add_argument("--steps", type=int, default=2000, help="環境ごとのstep数")
+    parser.add_argument("--frame", type=int, nargs=2, metavar=("W", "H"), help="縮小した画面も観測に含める")
+    args = parser.parse_args()
+    vec = VecEnv(args.envs, frame=tuple(args.frame) if args.frame else None)
+    vec.reset()
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    episodes = 0
+    for _ in range(args.steps):
+        _, _, terminated, truncated, _ = vec.step(rng.integers(0, 2, (args.envs, 4)))
+        episodes += int((terminated | truncated).sum())
+    elapsed = time.perf_counter()-start
+    vec.close()
+    total = args.envs*args.steps
+    print(f"{total} steps in {elapsed:.2f} s: {total/elapsed:.1f} steps/s ({args.envs} envs, {episodes} episodes)")
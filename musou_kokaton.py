@@ -1,26 +1,44 @@
+import argparse
+import csv
+import gzip
+import hashlib
+import json
 import math
 import os
 import random
 import sys
+import struct
+import threading
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 import pygame as pg
+try:
+    import numpy as np
+except ImportError:  # NumPyがなければ配列版の弾（ProjectileArrays）は使えない
+    np = None
 
 
 WIDTH = 1100  # ゲームウィンドウの幅
 HEIGHT = 650  # ゲームウィンドウの高さ
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
+SIM_FPS = 50  # シミュレーションの更新頻度（1秒あたりのstep数）
+MAX_STEPS = 5  # 1回の描画までに追いつくために回すstepの上限
+ROOT = os.path.dirname(os.path.abspath(__file__))  # 画像ファイル（fig/）の基準の場所（カレントディレクトリは変えない）
+START = time.perf_counter()  # 起動時刻（最初のフレームまでの時間を測る）
 
 
-def check_bound(obj_rct: pg.Rect) -> tuple[bool, bool]:
+def check_bound(obj_rct: pg.Rect, area: pg.Rect | None = None) -> tuple[bool, bool]:
     """
     オブジェクトが画面内or画面外を判定し，真理値タプルを返す関数
-    引数：こうかとんや爆弾，ビームなどのRect
+    引数1 obj_rct：こうかとんや爆弾，ビームなどのRect
+    引数2 area：判定する範囲（Noneなら画面，ステージではカメラに映っている範囲）
     戻り値：横方向，縦方向のはみ出し判定結果（画面内：True／画面外：False）
     """
+    left, top, right, bottom = (0, 0, WIDTH, HEIGHT) if area is None else (area.left, area.top, area.right, area.bottom)
     yoko, tate = True, True
-    if obj_rct.left < 0 or WIDTH < obj_rct.right:
+    if obj_rct.left < left or right < obj_rct.right:
         yoko = False
-    if obj_rct.top < 0 or HEIGHT < obj_rct.bottom:
+    if obj_rct.top < top or bottom < obj_rct.bottom:
         tate = False
     return yoko, tate
 
@@ -30,16 +48,650 @@ def calc_orientation(org: pg.Rect, dst: pg.Rect) -> tuple[float, float]:
     orgから見て，dstがどこにあるかを計算し，方向ベクトルをタプルで返す
     引数1 org：爆弾SurfaceのRect
     引数2 dst：こうかとんSurfaceのRect
-    戻り値：orgから見たdstの方向ベクトルを表すタプル
+    戻り値：orgから見たdstの方向ベクトルを表すタプル（中心が重なっているときは真下）
     """
     x_diff, y_diff = dst.centerx-org.centerx, dst.centery-org.centery
     norm = math.sqrt(x_diff**2+y_diff**2)
+    if norm == 0:
+        return 0.0, 1.0
     return x_diff/norm, y_diff/norm
 
 def check_landing(obj_rct: pg.Rect) -> bool:
     return obj_rct.bottom >= HEIGHT
 
-class Bird(pg.sprite.Sprite):
+
+class AssetCache:
+    """
+    画像ファイルを一度だけ読み込み，共有Surfaceとして配るクラス
+    表示用フォーマットへの変換（convert／convert_alpha）も読み込み時に一度だけ行う
+    アトラス（スプライト画像と変形画像を1枚に詰めた画像と領域の索引）があれば，
+    個別のファイルを読む代わりにその部分Surfaceを配る
+    prefetchしたファイルは別スレッドでデコードしておき，使うときに表示用フォーマットへの変換だけを行う
+    （変換は画面に依存するのでメインスレッドで行う）
+    """
+    opaque = {"fig/stage3.png", "fig/pg_bg.jpg"}  # 透過不要な背景画像
+
+    def __init__(self, lru_size: int = 128, workers: int | None = None, root: str = ""):
+        """
+        引数1 lru_size：動的な変形画像を保持する数の上限
+        引数2 workers：デコードに使うスレッド数（Noneなら論理CPU数，最大8）
+        引数3 root：画像ファイルのパス（キー）の基準のディレクトリ（""ならカレントディレクトリ）
+        """
+        self.root = root
+        self.imgs: dict[str, pg.Surface] = {}
+        self.hits = 0  # キャッシュから返せた回数
+        self.misses = 0  # ファイルから読み込んだ回数
+        self.variants: dict[tuple, pg.Surface] = {}  # ウォームアップ済みの変形画像（破棄しない）
+        self.lru: OrderedDict[tuple, pg.Surface] = OrderedDict()  # 動的な角度などの変形画像
+        self.lru_size = lru_size
+        self.v_hits = 0
+        self.v_misses = 0
+        self.atlas: pg.Surface | None = None  # 読み込んだアトラス画像
+        self.atlas_tried = False  # アトラスの読み込みを試したか
+        self.regions = 0  # アトラスから配っている画像の数
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self.executor: ThreadPoolExecutor | None = None  # 最初のprefetchで作る
+        self.pending: dict[str, Future] = {}  # デコード中（または済みで未変換）のファイル
+        self.prefetched = 0  # 別スレッドでデコードしたファイルの数
+
+    def _file(self, path: str) -> str:
+        """
+        画像ファイルのパス（キー）から実際に開くファイルのパスを作る
+        """
+        return os.path.join(self.root, path)
+
+    def _load(self, path: str) -> pg.Surface:
+        """
+        画像ファイルを読み込み，画面が生成済みなら表示用フォーマットに変換する
+        引数 path：画像ファイルのパス
+        戻り値：読み込んだ画像Surface
+        """
+        future = self.pending.pop(path, None)
+        img = future.result() if future is not None else pg.image.load(self._file(path))  # prefetch済みならその結果を待つ
+        if pg.display.get_surface() is not None:
+            img = img.convert() if path in __class__.opaque else img.convert_alpha()
+        return img
+
+    def get(self, path: str) -> pg.Surface:
+        """
+        キーに対応する共有Surfaceを返す（未読み込みならここで読み込む）
+        返したSurfaceは共有されるので，呼び出し側で書き換えないこと
+        引数 path：画像ファイルのパス（キー）
+        戻り値：画像Surface
+        """
+        img = self.imgs.get(path)
+        if img is not None:
+            self.hits += 1
+            return img
+        self.misses += 1
+        img = self.imgs[path] = self._load(path)
+        return img
+
+    def preload(self, paths: list[str]):
+        """
+        ゲーム開始前にまとめて読み込んでおく
+        引数 paths：画像ファイルのパスのリスト
+        """
+        for path in paths:
+            if path not in self.imgs:
+                self.misses += 1
+                self.imgs[path] = self._load(path)
+
+    def prefetch(self, paths: list[str]) -> list[Future]:
+        """
+        画像ファイルを別スレッドでデコードし始める（読み込み済み，デコード中のものは何もしない）
+        引数 paths：画像ファイルのパスのリスト
+        戻り値：デコード中のFutureのリスト
+        """
+        for path in paths:
+            if path in self.imgs or path in self.pending:
+                continue
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="assets")
+            self.pending[path] = self.executor.submit(pg.image.load, self._file(path))
+            self.prefetched += 1
+        return [self.pending[path] for path in paths if path in self.pending]
+
+    def startup_paths(self, atlas: str, paths: list[str]) -> list[str]:
+        """
+        起動時にデコードするファイルのリストを返す
+        アトラスが使えるならアトラスと，アトラスに入っていない画像だけ（使えなければpathsのまま）
+        """
+        index = self._atlas_index(atlas)
+        if index is None:
+            return paths
+        packed = {region["key"] for region in index["regions"] if isinstance(region["key"], str)}
+        return [atlas]+[path for path in paths if path not in packed]
+
+    @staticmethod
+    def _key(path: str, angle: float, scale: float, flip: tuple[bool, bool]) -> tuple:
+        """
+        変形画像のキーを作る（角度は1度単位に丸めて0以上360未満にそろえる）
+        """
+        return path, round(angle) % 360, scale, (bool(flip[0]), bool(flip[1]))
+
+    def _transform(self, key: tuple) -> pg.Surface:
+        """
+        キーに従って元画像を回転・拡大縮小・反転した画像Surfaceを作る
+        """
+        path, angle, scale, (fx, fy) = key
+        img = self.get(path)
+        if angle != 0 or scale != 1.0:
+            img = pg.transform.rotozoom(img, angle, scale)
+        if fx or fy:
+            img = pg.transform.flip(img, fx, fy)
+        return img
+
+    def variant(self, path: str, angle: float = 0, scale: float = 1.0,
+                flip: tuple[bool, bool] = (False, False)) -> pg.Surface:
+        """
+        回転・拡大縮小・反転した画像Surfaceを返す（一度作った変形画像は使い回す）
+        ウォームアップ済みのものは常に保持し，それ以外は上限付きのLRUで保持する
+        引数1 path：画像ファイルのパス
+        引数2 angle：回転角度（度）
+        引数3 scale：拡大率
+        引数4 flip：左右，上下の反転の真理値タプル
+        戻り値：変形後の画像Surface（共有されるので書き換えないこと）
+        """
+        key = __class__._key(path, angle, scale, flip)
+        img = self.variants.get(key)
+        if img is not None:
+            self.v_hits += 1
+            return img
+        img = self.lru.get(key)
+        if img is not None:
+            self.v_hits += 1
+            self.lru.move_to_end(key)
+            return img
+        self.v_misses += 1
+        img = self.lru[key] = self._transform(key)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)  # 最も長く使われていないものを捨てる
+        return img
+
+    def warmup(self, specs: list[tuple]):
+        """
+        よく使う変形画像を起動時に作っておく
+        引数 specs：(path, angle, scale, flip)のタプルのリスト
+        """
+        for spec in specs:
+            key = __class__._key(*spec)
+            if key not in self.variants:
+                self.variants[key] = self.lru.pop(key, None) or self._transform(key)
+
+    @staticmethod
+    def _index_path(path: str) -> str:
+        """
+        アトラス画像のパスから索引（JSON）のパスを作る
+        """
+        return os.path.splitext(path)[0]+".json"
+
+    def build_atlas(self, path: str, paths: list[str], specs: list[tuple], width: int = 1024) -> dict:
+        """
+        画像と変形画像を1枚のアトラス画像に詰めて，領域の索引とともに保存する
+        高さの順に並べて左から棚状に詰める（背景などの不透明な画像は入れない）
+        引数1 path：保存するアトラス画像（.png）のパス，索引は拡張子を.jsonにしたファイル
+        引数2 paths：入れる画像ファイルのパスのリスト
+        引数3 specs：入れる変形画像の(path, angle, scale, flip)のタプルのリスト
+        引数4 width：アトラス画像の幅
+        戻り値：書き出した索引の辞書
+        """
+        items = [(p, self._load(p)) for p in paths if p not in __class__.opaque]
+        items += [(__class__._key(*spec), self._transform(__class__._key(*spec))) for spec in specs]
+        items.sort(key=lambda item: -item[1].get_height())
+        regions = []
+        x = y = shelf = 0
+        for key, img in items:
+            w, h = img.get_size()
+            if x+w > width:  # 次の棚へ
+                x, y, shelf = 0, y+shelf+1, 0
+            regions.append((key, img, (x, y, w, h)))
+            x += w+1  # 1ピクセル空けて隣の画像がにじまないようにする
+            shelf = max(shelf, h)
+        atlas = pg.Surface((width, y+shelf), pg.SRCALPHA)
+        atlas.fill((0, 0, 0, 0))
+        atlas.blits([(img, rect[:2]) for _, img, rect in regions], doreturn=False)
+        pg.image.save(atlas, self._file(path))
+        sources = {p for key, _, _ in regions for p in ([key] if isinstance(key, str) else [key[0]])}
+        index = {
+            "version": 1,
+            "sources": {p: os.path.getmtime(self._file(p)) for p in sorted(sources)},
+            "regions": [{"key": key if isinstance(key, str) else [key[0], key[1], key[2], list(key[3])],
+                         "rect": list(rect)} for key, _, rect in regions],
+        }
+        with open(self._file(__class__._index_path(path)), "w") as f:
+            json.dump(index, f)
+        return index
+
+    def _atlas_index(self, path: str) -> dict | None:
+        """
+        アトラスの索引を読み込む（無いか，元画像の更新時刻が記録と違えばNone）
+        """
+        try:
+            with open(self._file(__class__._index_path(path))) as f:
+                index = json.load(f)
+            if index.get("version") != 1 or any(os.path.getmtime(self._file(p)) != t for p, t in index["sources"].items()):
+                return None
+        except (OSError, ValueError):
+            return None
+        return index
+
+    def load_atlas(self, path: str) -> bool:
+        """
+        アトラスがあれば読み込み，その部分Surfaceを画像・変形画像として登録する
+        元画像がアトラスより新しい（索引の記録と更新時刻が違う）ときは使わず，個別のファイルから読む
+        一度試したら以降は何もしない
+        引数 path：アトラス画像のパス
+        戻り値：アトラスを使っているか
+        """
+        if self.atlas_tried:
+            return self.atlas is not None
+        self.atlas_tried = True
+        index = self._atlas_index(path)
+        if index is None:
+            return False
+        try:
+            atlas = self._load(path)
+        except (OSError, pg.error):
+            return False
+        self.misses += 1
+        for region in index["regions"]:
+            key = region["key"]
+            img = atlas.subsurface(region["rect"])
+            if isinstance(key, str):
+                self.imgs.setdefault(key, img)
+            else:
+                self.variants.setdefault(__class__._key(key[0], key[1], key[2], key[3]), img)
+        self.atlas = atlas
+        self.regions = len(index["regions"])
+        return True
+
+    def stats(self) -> dict[str, int]:
+        """
+        キャッシュのヒット／ミス数と保持している画像数を返す
+        """
+        return {
+            "hits": self.hits, "misses": self.misses, "loaded": len(self.imgs),
+            "variant_hits": self.v_hits, "variant_misses": self.v_misses,
+            "variants": len(self.variants), "lru": len(self.lru), "atlas": self.regions,
+            "prefetched": self.prefetched,
+        }
+
+
+ASSETS = AssetCache(root=ROOT)
+PRELOAD = [f"fig/{i}.png" for i in range(10)] + [
+    "fig/beam.png", "fig/explosion.gif", "fig/file8080.png", "fig/stage3.png",
+]
+LAZY = ["fig/alien1.png", "fig/alien2.png", "fig/alien3.png"]  # 起動には要らず，最初のフレームの後に裏で読んでおく画像
+WARMUP = [  # 起動時に作っておく変形画像 (path, angle, scale, flip)
+    *[(f"fig/{i}.png", 0, 2.0, (fx, False)) for i in range(10) for fx in (False, True)],
+    *[("fig/beam.png", angle, size, (False, False)) for angle in (0, 180) for size in (1.0, 3.0)],
+    *[("fig/0.png", 0, 0.5+(n/10), (fx, False)) for n in range(1, 6) for fx in (False, True)],
+    *[("fig/explosion.gif", 0, size, flip) for size in (1.0, 0.5) for flip in ((False, False), (True, True))],
+    ("fig/file8080.png", 0, 2.0, (False, False)),
+]
+ATLAS = "fig/atlas.png"  # --build-atlasで作るアトラス画像（無ければ個別のファイルから読む）
+
+class SpatialHash:
+    """
+    一様グリッド（空間ハッシュ）による衝突判定の索引クラス
+    毎フレーム一度だけ作り直し，そのフレームの全ての衝突判定をこの索引で行う
+    """
+    def __init__(self, cell: int = 100):
+        """
+        引数 cell：セル一辺の大きさ（ピクセル）
+        """
+        self.cell = cell
+        self.cells: dict[tuple[int, int, str], list[pg.sprite.Sprite]] = {}
+
+    def _span(self, rct: pg.Rect) -> tuple[range, range]:
+        """
+        Rectが重なるセルの範囲を返す
+        """
+        c = self.cell
+        return range(rct.left//c, (rct.right-1)//c+1), range(rct.top//c, (rct.bottom-1)//c+1)
+
+    def rebuild(self, **groups: pg.sprite.AbstractGroup):
+        """
+        索引を作り直す
+        引数 groups：タグ名=グループ の形で索引に入れるグループを指定する
+        """
+        self.cells.clear()
+        cells = self.cells
+        for tag, group in groups.items():
+            for sprite in group:
+                xs, ys = self._span(sprite.rect)
+                for x in xs:
+                    for y in ys:
+                        cells.setdefault((x, y, tag), []).append(sprite)
+
+    def spritecollide(self, sprite: pg.sprite.Sprite, tag: str, dokill: bool) -> list[pg.sprite.Sprite]:
+        """
+        pg.sprite.spritecollideと同じ結果を索引から求める（kill済みのスプライトは除く）
+        引数1 sprite：判定するスプライト
+        引数2 tag：相手のグループのタグ名
+        引数3 dokill：Trueなら衝突した相手をkillする
+        戻り値：衝突した相手のリスト
+        """
+        rct = sprite.rect
+        found = {}
+        xs, ys = self._span(rct)
+        for x in xs:
+            for y in ys:
+                for other in self.cells.get((x, y, tag), ()):
+                    if other not in found and other.alive() and rct.colliderect(other.rect):
+                        found[other] = None
+        hits = list(found)
+        if dokill:
+            for other in hits:
+                other.kill()
+        return hits
+
+    def groupcollide(self, group: pg.sprite.AbstractGroup, tag: str,
+                     dokilla: bool, dokillb: bool) -> dict[pg.sprite.Sprite, list[pg.sprite.Sprite]]:
+        """
+        pg.sprite.groupcollideと同じ結果を索引から求める
+        引数1 group：判定するグループ
+        引数2 tag：相手のグループのタグ名
+        引数3 dokilla：Trueなら衝突したgroup側のスプライトをkillする
+        引数4 dokillb：Trueなら衝突した相手をkillする
+        戻り値：group側のスプライトをキー，衝突した相手のリストを値とする辞書
+        """
+        crashed = {}
+        for sprite in group.sprites():
+            hits = self.spritecollide(sprite, tag, dokillb)
+            if hits:
+                crashed[sprite] = hits
+                if dokilla:
+                    sprite.kill()
+        return crashed
+
+
+class Background:
+    """
+    背景の層を重ねて描くクラス
+    層は下から順に(画像ファイル, 視差)で指定し，視差はカメラの移動量に対する層の移動量の割合（0なら動かない）
+    下から続く視差0の層は画面の大きさに切り取って1枚のSurfaceに一度だけ合成しておき，毎フレーム1回の転送で済ませる
+    動く層は画像とその左右反転を並べた継ぎ目のない帯を一度だけ作り，カメラに応じた範囲を転送する
+    （帯の端をまたぐときだけ2回に分ける）
+    """
+    def __init__(self, layers: list[tuple[str, float]]):
+        """
+        引数 layers：下から順の(画像ファイル, 視差)のリスト
+        """
+        t0 = time.perf_counter()
+        self.surf: pg.Surface | None = None  # 動かない層を合成したSurface（動く層が一番下ならNone）
+        self.strips: list[tuple[pg.Surface, float]] = []  # 動く層の(帯, 視差)
+        for path, factor in layers:
+            img = ASSETS.get(path)
+            if factor == 0 and not self.strips:
+                if self.surf is None:
+                    self.surf = pg.Surface((WIDTH, HEIGHT))
+                    if pg.display.get_surface() is not None:
+                        self.surf = self.surf.convert()
+                self.surf.blit(img, (0, 0))
+            else:
+                self.strips.append((self._strip(img), factor))
+        self.build_ms = (time.perf_counter()-t0)*1000
+
+    @staticmethod
+    def _strip(img: pg.Surface) -> pg.Surface:
+        """
+        画像の右に左右反転した画像を並べ，左右の端がつながる帯（高さは画面まで）を作る
+        """
+        w, h = img.get_width(), min(img.get_height(), HEIGHT)
+        strip = pg.Surface((2*w, h), img.get_flags() & pg.SRCALPHA, img)
+        strip.blit(img, (0, 0))
+        strip.blit(pg.transform.flip(img, True, False), (w, 0))
+        return strip
+
+    def draw(self, screen: pg.Surface, cam_x: float = 0):
+        """
+        背景を画面に描く
+        引数1 screen：画面Surface
+        引数2 cam_x：カメラの左端のx座標
+        """
+        if self.surf is not None:
+            screen.blit(self.surf, (0, 0))
+        for strip, factor in self.strips:
+            period = strip.get_width()
+            x = int(cam_x*factor)%period
+            w = min(WIDTH, period-x)
+            screen.blit(strip, (0, 0), (x, 0, w, strip.get_height()))
+            if w < WIDTH:  # 帯の端をまたぐ分は先頭から続けて描く
+                screen.blit(strip, (w, 0), (0, 0, WIDTH-w, strip.get_height()))
+
+    def stats(self) -> dict[str, float]:
+        """
+        層の構成と合成にかかった時間を返す
+        """
+        return {"static": self.surf is not None, "scrolling": len(self.strips), "build_ms": self.build_ms}
+
+
+class Stage:
+    """
+    タイルマップのステージ（地形）に関するクラス
+    ステージファイルは1文字1タイルのテキストで，行数×TILEが画面の高さになる（短い行は空白で埋める）
+    地形はCHUNK列ごとのSurfaceに一度だけ描いておき，カメラに映る分だけを転送する
+    描いたSurfaceは上限付きのLRUで保持し，離れた部分は捨てる
+    当たり判定は矩形が重なるタイルだけを引く（グリッド参照）
+    """
+    TILE = 50  # タイル一辺の大きさ（ピクセル）
+    CHUNK = 8  # 1つのSurfaceにまとめる列数
+    tiles = {  # 文字：(色, 当たり判定があるか)
+        "#": ((110, 70, 40), True),  # 地面
+        "=": ((170, 90, 60), True),  # レンガの足場
+        "*": ((60, 150, 60), False),  # 草むら（飾り）
+    }
+    key = (255, 0, 255)  # 透過色
+
+    def __init__(self, path: str, cache_size: int = 8):
+        """
+        引数1 path：ステージファイルのパス
+        引数2 cache_size：保持するチャンクSurfaceの数の上限
+        """
+        with open(path, encoding="utf-8") as f:
+            rows = [line.rstrip("\n") for line in f if not line.startswith(";")]  # ;で始まる行は注釈
+        if not any(rows):
+            raise ValueError(f"{path} にタイルの行がありません")
+        self.rows = len(rows)
+        self.cols = max(len(row) for row in rows)
+        self.map = [row.ljust(self.cols, ".") for row in rows]
+        self.width = max(self.cols*__class__.TILE, WIDTH)
+        self.height = self.rows*__class__.TILE
+        self.solid = bytearray(self.rows*self.cols)  # 当たり判定のあるタイル（行優先）
+        for r, row in enumerate(self.map):
+            for c, ch in enumerate(row):
+                if __class__.tiles.get(ch, (None, False))[1]:
+                    self.solid[r*self.cols+c] = 1
+        self.solid_arr = None if np is None else np.frombuffer(self.solid, dtype=np.uint8).reshape(self.rows, self.cols)
+        self.chunks: OrderedDict[int, pg.Surface] = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def solid_at(self, c: int, r: int) -> bool:
+        """
+        c列r行のタイルに当たり判定があるか（ステージの外は無し）
+        """
+        return 0 <= c < self.cols and 0 <= r < self.rows and self.solid[r*self.cols+c] == 1
+
+    def collide(self, rct: pg.Rect) -> bool:
+        """
+        rctが当たり判定のあるタイルと重なっているか
+        """
+        t = __class__.TILE
+        for r in range(rct.top//t, (rct.bottom-1)//t+1):
+            for c in range(rct.left//t, (rct.right-1)//t+1):
+                if self.solid_at(c, r):
+                    return True
+        return False
+
+    def spritecollide(self, group: pg.sprite.Group) -> list[pg.sprite.Sprite]:
+        """
+        地形と重なっているスプライトのリストを返す
+        """
+        return [sprite for sprite in group if self.collide(sprite.rect)]
+
+    def array_hits(self, arr: "ProjectileArrays"):
+        """
+        配列版の弾のうち，中心が当たり判定のあるタイルに入っているものの番号の配列を返す
+        """
+        pos = arr.pos[:arr.n]
+        c = (pos[:, 0]//__class__.TILE).astype(np.intp)
+        r = (pos[:, 1]//__class__.TILE).astype(np.intp)
+        inside = (c >= 0) & (c < self.cols) & (r >= 0) & (r < self.rows)
+        hit = np.zeros(arr.n, dtype=bool)
+        hit[inside] = self.solid_arr[r[inside], c[inside]] == 1
+        return np.flatnonzero(hit)
+
+    def floor(self, rct: pg.Rect) -> int:
+        """
+        rctの真下で一番上にある地形の上端のy座標を返す（地形がなければHEIGHT）
+        """
+        t = __class__.TILE
+        for r in range(max(rct.top//t, 0), self.rows):
+            if any(self.solid_at(c, r) for c in range(rct.left//t, (rct.right-1)//t+1)):
+                return r*t
+        return HEIGHT
+
+    def _render(self, i: int) -> pg.Surface:
+        """
+        i番目のチャンク（CHUNK列分）の地形を描いたSurfaceを作る
+        """
+        t = __class__.TILE
+        surf = pg.Surface((__class__.CHUNK*t, self.height))
+        if pg.display.get_surface() is not None:
+            surf = surf.convert()
+        surf.fill(__class__.key)
+        for r, row in enumerate(self.map):
+            for c in range(i*__class__.CHUNK, min((i+1)*__class__.CHUNK, self.cols)):
+                tile = __class__.tiles.get(row[c])
+                if tile is None:
+                    continue
+                rct = pg.Rect((c-i*__class__.CHUNK)*t, r*t, t, t)
+                pg.draw.rect(surf, tile[0], rct)
+                pg.draw.rect(surf, [v//2 for v in tile[0]], rct, 2)  # 縁取り
+        surf.set_colorkey(__class__.key, pg.RLEACCEL)
+        return surf
+
+    def chunk(self, i: int) -> pg.Surface:
+        """
+        i番目のチャンクSurfaceを返す（未作成ならここで描き，古いものを捨てる）
+        """
+        surf = self.chunks.get(i)
+        if surf is not None:
+            self.hits += 1
+            self.chunks.move_to_end(i)
+            return surf
+        self.misses += 1
+        surf = self.chunks[i] = self._render(i)
+        if len(self.chunks) > self.cache_size:
+            self.chunks.popitem(last=False)
+        return surf
+
+    def draw(self, screen: pg.Surface, cam_x: int):
+        """
+        カメラに映っているチャンクだけを画面に転送する
+        引数1 screen：画面Surface
+        引数2 cam_x：カメラの左端のx座標
+        """
+        w = __class__.CHUNK*__class__.TILE
+        first = max(cam_x//w, 0)
+        last = min((cam_x+WIDTH-1)//w, (self.cols-1)//__class__.CHUNK)
+        screen.blits([(self.chunk(i), (i*w-cam_x, 0)) for i in range(first, last+1)], doreturn=False)
+
+    def stats(self) -> dict[str, int]:
+        """
+        チャンクSurfaceのキャッシュのヒット／ミス数と保持数を返す
+        """
+        return {"hits": self.hits, "misses": self.misses, "chunks": len(self.chunks)}
+
+
+class Pool:
+    """
+    スプライトを使い回すためのオブジェクトプール
+    killされたインスタンスはSurfaceやRectごと保持しておき，次の生成時にresetして再利用する
+    """
+    def __init__(self, cls: type, capacity: int, overflow: str = "recycle"):
+        """
+        引数1 cls：プールするクラス（reset()を持つPooledの派生クラス）
+        引数2 capacity：同時に使えるインスタンス数の上限
+        引数3 overflow：上限を超えたときの方針
+            "recycle"：一番古いインスタンスを消して再利用する
+            "drop"：生成しない（Noneを返す）
+            "grow"：新しく生成する（上限を超えた分は解放時にプールへ戻さない）
+        """
+        self.cls = cls
+        self.capacity = capacity
+        self.overflow = overflow
+        self.free: list[Pooled] = []
+        self.active: dict[Pooled, None] = {}  # 使用中のインスタンス（生成順）
+        self.created = 0
+        self.reused = 0
+        self.recycled = 0
+        self.dropped = 0
+
+    def acquire(self, *args) -> "Pooled|None":
+        """
+        インスタンスを取り出す（空きがなければ生成する）
+        引数 args：cls.reset()に渡す引数
+        戻り値：初期化済みのインスタンス（"drop"で上限を超えたときはNone）
+        """
+        if self.free:
+            obj = self.free.pop()
+            obj.reset(*args)
+            self.reused += 1
+        elif len(self.active) < self.capacity or self.overflow == "grow":
+            obj = self.cls(*args)
+            obj.pool = self
+            self.created += 1
+        elif self.overflow == "drop":
+            self.dropped += 1
+            return None
+        else:
+            next(iter(self.active)).kill()  # 一番古いものを消してプールへ戻す
+            obj = self.free.pop()
+            obj.reset(*args)
+            self.recycled += 1
+        self.active[obj] = None
+        return obj
+
+    def release(self, obj: "Pooled"):
+        """
+        使い終わったインスタンスをプールへ戻す（kill()から呼ばれる）
+        """
+        if obj not in self.active:
+            return
+        del self.active[obj]
+        if len(self.active)+len(self.free) < self.capacity:
+            self.free.append(obj)
+
+    def stats(self) -> dict[str, int]:
+        """
+        プールの使用状況を返す
+        """
+        return {
+            "active": len(self.active), "free": len(self.free), "capacity": self.capacity,
+            "created": self.created, "reused": self.reused,
+            "recycled": self.recycled, "dropped": self.dropped,
+        }
+
+
+class Pooled:
+    """
+    Poolで使い回すスプライトの共通クラス
+    kill()されたらプールへ戻る
+    """
+    pool: Pool | None = None
+
+    def kill(self):
+        super().kill()
+        if self.pool is not None:
+            self.pool.release(self)
+
+
+class Bird(pg.sprite.DirtySprite):
     """
     ゲームキャラクター（こうかとん）に関するクラス
     """
@@ -56,8 +708,8 @@ class Bird(pg.sprite.Sprite):
         引数2 xy：こうかとん画像の位置座標タプル
         """
         super().__init__()
-        img0 = pg.transform.rotozoom(pg.image.load(f"fig/{num}.png"), 0, 2.0)
-        img = pg.transform.flip(img0, True, False)  # デフォルトのこうかとん
+        img0 = ASSETS.variant(f"fig/{num}.png", 0, 2.0)
+        img = ASSETS.variant(f"fig/{num}.png", 0, 2.0, (True, False))  # デフォルトのこうかとん
         self.imgs = {
             (+1, 0): img,  # 右
             (-1, 0): img0,  # 左
@@ -71,31 +723,41 @@ class Bird(pg.sprite.Sprite):
         self.is_jumping = False
         self.hp = 100
         self.fall_speed = 5
-        self.state = "normal"
 
-    def change_img(self, num: int, screen: pg.Surface):
+    def change_img(self, num: int, screen: pg.Surface | None = None):
         """
         こうかとん画像を切り替え，画面に転送する
         引数1 num：こうかとん画像ファイル名の番号
-        引数2 screen：画面Surface
+        引数2 screen：画面Surface（Noneなら画像を切り替えるだけ）
         """
-        self.image = pg.transform.rotozoom(pg.image.load(f"fig/{num}.png"), 0, 2.0)
-        screen.blit(self.image, self.rect)
+        self.image = ASSETS.variant(f"fig/{num}.png", 0, 2.0)
+        self.dirty = 1
+        if screen is not None:
+            screen.blit(self.image, self.rect)
 
-    def update(self, key_lst: list[bool], screen: pg.Surface):
+    def update(self, key_lst: list[bool], screen: pg.Surface | None = None, stage: Stage | None = None):
         """
         押下キーに応じてこうかとんを移動させる
         左右で左右に移動
         上でジャンプ
         引数1 key_lst：押下キーの真理値リスト
-        引数2 screen：画面Surface
+        引数2 screen：画面Surface（Noneなら転送しない）
+        引数3 stage：ステージ（あれば地形の上を歩き，地形に当たって止まる）
         """
+        old_rct, old_img = self.rect.copy(), self.image
+
         # 水平方向の移動量を計算
         sum_mv = [0, 0]
         for k in [pg.K_LEFT, pg.K_RIGHT]:
             if key_lst[k]:
                 sum_mv[0] += __class__.delta[k][0]
 
+        if stage is not None:
+            self._move_on(stage, key_lst, sum_mv[0])
+            if self.rect != old_rct or self.image is not old_img:
+                self.dirty = 1
+            return
+
         # ジャンプの処理
         if not self.is_jumping and key_lst[pg.K_UP]:
             self.is_jumping = True
@@ -128,85 +790,153 @@ class Bird(pg.sprite.Sprite):
         if self.rect.bottom > HEIGHT:
             self.rect.bottom = HEIGHT
 
-        screen.blit(self.image, self.rect)
+        if self.rect != old_rct or self.image is not old_img:
+            self.dirty = 1  # 動いたか画像が変わったときだけ再描画する
+        if screen is not None:
+            screen.blit(self.image, self.rect)
+
+    def _move_on(self, stage: Stage, key_lst: list[bool], mv: int):
+        """
+        ステージの地形との当たり判定をしながら移動させる（横，縦の順に動かして，めり込んだらタイルの端に戻す）
+        引数1 stage：ステージ
+        引数2 key_lst：押下キーの真理値リスト
+        引数3 mv：水平方向の移動の向き（-1，0，+1）
+        """
+        t = Stage.TILE
+        if mv != 0:
+            self.rect.move_ip(self.speed*mv, 0)
+            self.dire = (mv, 0)
+            self.image = self.imgs[self.dire]
+            if stage.collide(self.rect):
+                if mv > 0:
+                    self.rect.right = self.rect.right//t*t
+                else:
+                    self.rect.left = (self.rect.left//t+1)*t
+            self.rect.left = max(self.rect.left, 0)
+            self.rect.right = min(self.rect.right, stage.width)
+
+        # 足元に地形か画面下端があれば着地している
+        on_ground = self.rect.bottom >= HEIGHT or stage.collide(self.rect.move(0, 1))
+        if on_ground:
+            self.fall_speed = self.jump_speed if key_lst[pg.K_UP] else 0
+        self.is_jumping = not on_ground or self.fall_speed < 0
+        self.rect.move_ip(0, self.fall_speed)
+        self.fall_speed += 0.5  # 重力加速度
+        if stage.collide(self.rect):
+            if self.fall_speed > 0:  # 落ちていたら地形の上に乗る
+                self.rect.bottom = self.rect.bottom//t*t
+            else:  # 上がっていたら天井に頭をぶつける
+                self.rect.top = (self.rect.top//t+1)*t
+            self.fall_speed = 0
+        self.rect.top = max(self.rect.top, 0)
+        self.rect.bottom = min(self.rect.bottom, HEIGHT)
 
-class Bomb(pg.sprite.Sprite):
+class Bomb(Pooled, pg.sprite.DirtySprite):
     """
     爆弾に関するクラス
     """
     colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (255, 0, 255), (0, 255, 255)]
+    imgs: dict[tuple[int, int, int], pg.Surface] = {}  # 色ごとの爆弾円Surface（全爆弾で共有）
+
+    def __init__(self, emy: "Boss", bird: Bird, rng: random.Random = random):
+        super().__init__()
+        self.rect = pg.Rect(0, 0, 0, 0)
+        self.reset(emy, bird, rng)
+
+    @classmethod
+    def image_for(cls, color: tuple[int, int, int]) -> pg.Surface:
+        """
+        色に対応する共有の爆弾円Surfaceを返す（初回だけ描く）
+        """
+        if color not in cls.imgs:
+            rad = 15  # 爆弾円の半径
+            img = pg.Surface((2*rad, 2*rad))
+            pg.draw.circle(img, color, (rad, rad), rad)
+            img.set_colorkey((0, 0, 0))
+            cls.imgs[color] = img
+        return cls.imgs[color]
 
-    def __init__(self, emy: "Boss", bird: Bird):
+    def reset(self, emy: "Boss", bird: Bird, rng: random.Random = random):
         """
-        爆弾円Surfaceを生成する
+        爆弾円Surfaceを設定し，投下位置と方向を初期化する
         引数1 emy：爆弾を投下する敵機
         引数2 bird：攻撃対象のこうかとん
+        引数3 rng：色を決める乱数生成器
         """
-        super().__init__()
-        rad = 15  # 爆弾円の半径：10以上50以下の乱数
-        self.image = pg.Surface((2*rad, 2*rad))
-        color = random.choice(__class__.colors)  # 爆弾円の色：クラス変数からランダム選択
-        pg.draw.circle(self.image, color, (rad, rad), rad)
-        self.image.set_colorkey((0, 0, 0))
-        self.rect = self.image.get_rect()
+        self.dirty = 2  # 毎フレーム動くので常に再描画する（LayeredDirty用）
+        color = rng.choice(__class__.colors)  # 爆弾円の色：クラス変数からランダム選択
+        self.image = __class__.image_for(color)
+        self.rect.size = self.image.get_size()
         # 爆弾を投下するemyから見た攻撃対象のbirdの方向を計算
         self.vx, self.vy = calc_orientation(emy.rect, bird.rect)  
         self.rect.centerx = emy.rect.centerx
         self.rect.centery = emy.rect.centery+emy.rect.height//2
         self.speed = 15
 
-    def update(self):
+    def update(self, area: pg.Rect | None = None):
         """
         爆弾を速度ベクトルself.vx, self.vyに基づき移動させる
-        引数 screen：画面Surface
+        引数 area：この範囲から出たら消す（Noneなら画面）
         """
         self.rect.move_ip(self.speed*self.vx, self.speed*self.vy)
-        if check_bound(self.rect) != (True, True):
+        if check_bound(self.rect, area) != (True, True):
             self.kill()
         
 
-class Beam(pg.sprite.Sprite):
+class Beam(Pooled, pg.sprite.DirtySprite):
     """
     ビームに関するクラス
     """
+    cap = 64  # 同時に出せる数（配列版も同じ上限で，超えた分は撃てない）
+
     def __init__(self, bird: Bird, angle0: int):
+        super().__init__()
+        self.rect = pg.Rect(0, 0, 0, 0)
+        self.reset(bird, angle0)
+
+    def reset(self, bird: Bird, angle0: int):
         """
-        ビーム画像Surfaceを生成する
+        ビーム画像Surfaceを設定し，発射位置と方向を初期化する
         引数 bird：ビームを放つこうかとん
         """
-        super().__init__()
+        self.dirty = 2
         self.vx, self.vy = bird.dire
         angle = math.degrees(math.atan2(-self.vy, self.vx))
         self.speed = 10
         self.size = 1.0
         self.dmg = 1
-        self.image = pg.transform.rotozoom(pg.image.load(f"fig/beam.png"), angle, self.size)
+        self.image = ASSETS.variant("fig/beam.png", angle, self.size)
         self.vx = math.cos(math.radians(angle))
         self.vy = -math.sin(math.radians(angle))
-        self.rect = self.image.get_rect()
+        self.rect.size = self.image.get_size()
         self.rect.centery = bird.rect.centery+bird.rect.height*self.vy
         self.rect.centerx = bird.rect.centerx+bird.rect.width*self.vx
 
-    def update(self):
+    def update(self, area: pg.Rect | None = None):
         """
         ビームを速度ベクトルself.vx, self.vyに基づき移動させる
-        引数 screen：画面Surface
+        引数 area：この範囲から出たら消す（Noneなら画面）
         """
         self.rect.move_ip(self.speed*self.vx, self.speed*self.vy)
-        if check_bound(self.rect) != (True, True):
+        if check_bound(self.rect, area) != (True, True):
             self.kill()
 
-class Chargebeam(pg.sprite.Sprite):
+class Chargebeam(Pooled, pg.sprite.DirtySprite):
     """
     チャージビームに関するクラス
     """
     def __init__(self, bird: Bird, f: int):
+        super().__init__()
+        self.rect = pg.Rect(0, 0, 0, 0)
+        self.reset(bird, f)
+
+    def reset(self, bird: Bird, f: int):
         """
-        ビーム画像Surfaceを生成する
+        ビーム画像Surfaceを設定し，発射位置と方向を初期化する
         引数 bird：ビームを放つこうかとん
              f：フレーム数
         """
-        super().__init__()
+        self.dirty = 2
         self.vx, self.vy = bird.dire
         angle = math.degrees(math.atan2(-self.vy, self.vx))
         self.speed = 20
@@ -214,73 +944,154 @@ class Chargebeam(pg.sprite.Sprite):
         self.dmg = 2
         self.life = 3
 
-        self.image = pg.transform.rotozoom(pg.image.load(f"fig/beam.png"), angle, self.size)
+        self.image = ASSETS.variant("fig/beam.png", angle, self.size)
         self.vx = math.cos(math.radians(angle))
         self.vy = -math.sin(math.radians(angle))
-        self.rect = self.image.get_rect()
+        self.rect.size = self.image.get_size()
         self.rect.centery = bird.rect.centery+bird.rect.height*self.vy
         self.rect.centerx = bird.rect.centerx+bird.rect.width*self.vx
 
-    def update(self):
+    def update(self, area: pg.Rect | None = None):
         """
         ビームを速度ベクトルself.vx, self.vyに基づき移動させる
-        引数 screen：画面Surface
+        引数 area：この範囲から出たら消す（Noneなら画面）
         """
         self.rect.move_ip(self.speed*self.vx, self.speed*self.vy)
 
-        if check_bound(self.rect) != (True, True):
-            self.kill
+        if check_bound(self.rect, area) != (True, True):
+            self.kill()
 
-class Explosion(pg.sprite.Sprite):
+class Particles:
     """
-    爆発に関するクラス
+    爆発エフェクトをまとめて扱うパーティクルクラス
+    1つ1つをスプライトにせず，位置と残り時間を並列のリストで持ち，共有の画像Surfaceから1回のblitsで描く
+    同じ場所に重なった爆発は1つにまとめ（残り時間を延ばす），全体の数には上限（budget）を設ける
+    数が多いときは小さい画像（LOD）で描く
     """
-    def __init__(self, obj: "Bomb|Boss", life: int):
+    path = "fig/explosion.gif"
+
+    def __init__(self, budget: int = 128, merge: int = 24, lod: int | None = None):
+        """
+        引数1 budget：同時に出せる爆発の上限（超えた分は出さない）
+        引数2 merge：既にある爆発とこの距離（ピクセル）以内なら1つにまとめる
+        引数3 lod：爆発がこの数以上あるときは小さい画像で出す（Noneならbudgetの半分）
+        """
+        self.frames = []  # [大きさ][コマ] の画像と，中心からの左上のずれ
+        for scale in (1.0, 0.5):
+            imgs = [ASSETS.variant(__class__.path, 0, scale), ASSETS.variant(__class__.path, 0, scale, (True, True))]
+            self.frames.append([(img, (-img.get_width()//2, -img.get_height()//2)) for img in imgs])
+        self.budget = budget
+        self.merge = merge
+        self.lod = budget//2 if lod is None else lod
+        self.xs: list[int] = []  # 中心座標
+        self.ys: list[int] = []
+        self.lives: list[int] = []  # 残り時間（フレーム数）
+        self.sizes: list[int] = []  # 画像の大きさ（0：通常，1：小さい）
+        self.merged = 0  # まとめた数
+        self.dropped = 0  # 上限で出さなかった数
+        self.animate = True  # コマを切り替えるか（Falseなら最初のコマのまま）
+        self.draw_cap: int | None = None  # 描く数の上限（Noneなら全て）
+
+    def __len__(self) -> int:
+        return len(self.lives)
+
+    def add(self, obj: "Bomb|Boss|Minion|tuple[int, int]", life: int):
         """
-        爆弾が爆発するエフェクトを生成する
-        引数1 obj：爆発するBombまたは敵機インスタンス
+        爆発を1つ出す
+        引数1 obj：爆発するBombまたは敵機インスタンス（配列版の弾のときは中心座標のタプル）
         引数2 life：爆発時間
         """
-        super().__init__()
-        img = pg.image.load(f"fig/explosion.gif")
-        self.imgs = [img, pg.transform.flip(img, 1, 1)]
-        self.image = self.imgs[0]
-        self.rect = self.image.get_rect(center=obj.rect.center)
-        self.life = life
+        x, y = obj if isinstance(obj, tuple) else obj.rect.center
+        xs, ys, lives = self.xs, self.ys, self.lives
+        m = self.merge
+        for i in range(len(lives)):
+            if abs(xs[i]-x) <= m and abs(ys[i]-y) <= m:  # 重なる爆発は残り時間を延ばすだけにする
+                if lives[i] < life:
+                    lives[i] = life
+                self.merged += 1
+                return
+        if len(lives) >= self.budget:
+            self.dropped += 1
+            return
+        xs.append(x)
+        ys.append(y)
+        lives.append(life)
+        self.sizes.append(1 if len(lives) > self.lod else 0)
 
     def update(self):
         """
-        爆発時間を1減算した爆発経過時間_lifeに応じて爆発画像を切り替えることで
-        爆発エフェクトを表現する
+        残り時間を1減らし，尽きたものを消す（末尾と入れ替えて消す）
         """
-        self.life -= 1
-        self.image = self.imgs[self.life//10%2]
-        if self.life < 0:
-            self.kill()
+        xs, ys, lives, sizes = self.xs, self.ys, self.lives, self.sizes
+        i = 0
+        while i < len(lives):
+            lives[i] -= 1
+            if lives[i] < 0:
+                xs[i], ys[i], lives[i], sizes[i] = xs[-1], ys[-1], lives[-1], sizes[-1]
+                xs.pop(), ys.pop(), lives.pop(), sizes.pop()
+                continue  # 入れ替えで来たものはまだ減らしていないので，同じ位置をもう一度見る
+            i += 1
+
+    def clear(self):
+        """
+        全ての爆発を消す
+        """
+        self.xs.clear()
+        self.ys.clear()
+        self.lives.clear()
+        self.sizes.clear()
+
+    def draw(self, screen: pg.Surface, alpha: float = 1.0, doreturn: bool = False, cam_x: float = 0):
+        """
+        全ての爆発を1回のblitsで描画する（動かないので補間はしない）
+        引数1 screen：画面Surface
+        引数2 alpha：ProjectileArrays.drawと引数をそろえるためのもの（使わない）
+        引数3 doreturn：Trueなら描画した範囲のリストを返す
+        引数4 cam_x：カメラの左端のx座標
+        """
+        frames = self.frames
+        animate = self.animate
+        blits = []
+        for x, y, life, size in zip(self.xs[:self.draw_cap], self.ys, self.lives, self.sizes):
+            img, (dx, dy) = frames[size][life//10%2 if animate else 0]
+            blits.append((img, (x+dx-cam_x, y+dy)))
+        return screen.blits(blits, doreturn=doreturn)
+
+    def stats(self) -> dict[str, int]:
+        """
+        爆発の数とまとめた数，上限で出さなかった数を返す
+        """
+        return {"live": len(self.lives), "merged": self.merged, "dropped": self.dropped}
 
 
-class Boss(pg.sprite.Sprite):
+class Boss(pg.sprite.DirtySprite):
     """
     敵(ボス)に関するクラス
     """ 
-    def __init__(self):
+    def __init__(self, rng: random.Random = random):
+        """
+        引数 rng：爆弾投下インターバルを決める乱数生成器
+        """
         super().__init__()
-        self.image = pg.transform.rotozoom(pg.image.load("fig/file8080.png"), 0, 2.0)
+        self.dirty = 2
+        self.image = ASSETS.variant("fig/file8080.png", 0, 2.0)
         self.rect = self.image.get_rect()
         self.rect.center = 700, 0
         self.vx, self.vy = 0, +6
         self.bound = HEIGHT-200  # 停止位置
         self.state = "down"  # 降下状態or停止状態
-        self.interval = random.randint(50, 300)  # 爆弾投下インターバル
+        self.interval = rng.randint(50, 300)  # 爆弾投下インターバル
+        self.fire = "aimed"  # 爆弾の撃ち方（WaveSchedulerの撃ち方を参照）
         self.tmr = 0
         self.hp = 50 # 敵のHPの初期値
         
-    def update(self):
+    def update(self, area: pg.Rect | None = None):
         """
         敵をstateに基づき移動させる
         決めた停止位置_boundまで降下したら，_stateを停止状態に変更する
-        引数 screen：画面Surface
+        引数 area：左右に往復する範囲（Noneなら画面，ステージではカメラに映っている範囲）
         """
+        left = 0 if area is None else area.left
         if self.hp <= 0: # hpが0になった時に、selfをkill
             self.kill()
         
@@ -306,16 +1117,280 @@ class Boss(pg.sprite.Sprite):
                 self.tmr = 0
                 self.vx = 6
 
-        if self.rect.centerx < 100: # self.rect.centerxが100より小さい時に、反転し、stateをstopに変える
+        if self.rect.centerx < left+100: # self.rect.centerxが100より小さい時に、反転し、stateをstopに変える
             self.vx *= -1
             self.state = "stop"
             
-        if self.rect.centerx > 1000: # self.rect.centerxが1000より大きい時に、反転し、stateをstop_dに変える
+        if self.rect.centerx > left+1000: # self.rect.centerxが1000より大きい時に、反転し、stateをstop_dに変える
             self.vx *= -1
             self.state = "stop_d"
         
         self.rect.move_ip(self.vx, self.vy)
 
+    def can_fire(self, area: pg.Rect) -> bool:
+        """
+        爆弾を投下できるか（降下し終わったら投下する）
+        """
+        return self.state != "down"
+
+
+class Minion(pg.sprite.DirtySprite):
+    """
+    雑魚敵に関するクラス
+    移動は毎フレーム行うが，こうかとんを追う判断（think）はWaveSchedulerが数フレームに一度だけ呼ぶ
+    """
+    def __init__(self, xy: tuple[float, float], vel: tuple[float, float], pattern: str = "line", hp: int = 2,
+                 fire: str = "aimed", interval: int = 90, img: str = "fig/alien1.png"):
+        """
+        引数1 xy：出現位置の中心座標
+        引数2 vel：1フレームの移動量
+        引数3 pattern：動き方（"line"：直進，"sine"：上下に揺れながら進む，"homing"：こうかとんの真上へ寄っていく）
+        引数4 hp：HP
+        引数5 fire：爆弾の撃ち方（"aimed"，"spread"，"down"，"none"）
+        引数6 interval：爆弾を撃つ間隔（フレーム数）
+        引数7 img：画像ファイルのパス
+        """
+        super().__init__()
+        self.dirty = 2
+        self.image = ASSETS.get(img)
+        self.rect = self.image.get_rect(center=xy)
+        self.x, self.y = float(xy[0]), float(xy[1])  # 揺れを除いた中心座標
+        self.vx, self.vy = vel
+        self.speed = max(abs(vel[0]), 2)  # homingで寄っていく速さ
+        self.pattern = pattern
+        self.hp = hp
+        self.fire = fire
+        self.interval = interval
+        self.t = 0  # 出現してからのフレーム数
+        self.entered = False  # 一度でも画面に入ったか
+        self.waited = 0  # 画面に入るまでに過ぎたフレーム数（WaveSchedulerが数える）
+        self.bucket = 0  # thinkを呼ぶフレームの組（WaveSchedulerが決める）
+
+    def think(self, bird: Bird):
+        """
+        こうかとんの位置を見て進む向きを決め直す
+        """
+        if self.pattern == "homing":
+            dx = bird.rect.centerx-self.rect.centerx
+            self.vx = 0 if abs(dx) < self.speed else math.copysign(self.speed, dx)
+
+    def update(self, area: pg.Rect | None = None):
+        """
+        速度とpatternに従って移動させる（HPが0になったら消す）
+        引数 area：カメラに映っている範囲（Noneなら画面）
+        """
+        if self.hp <= 0:
+            self.kill()
+            return
+        self.t += 1
+        self.x += self.vx
+        self.y += self.vy
+        dy = 40*math.sin(self.t/15) if self.pattern == "sine" else 0
+        self.rect.center = round(self.x), round(self.y+dy)
+        if not self.entered:
+            self.entered = (area or pg.Rect(0, 0, WIDTH, HEIGHT)).colliderect(self.rect)
+
+    def can_fire(self, area: pg.Rect) -> bool:
+        """
+        爆弾を撃てるか（画面に映っているときだけ撃つ）
+        """
+        return area.colliderect(self.rect)
+
+
+class WaveScheduler:
+    """
+    ステージ定義（ウェーブのリスト）に従って敵を出現させ，爆弾を撃たせ，敵の更新を間引くクラス
+    ウェーブは辞書で，次のキーを持つ（at以外は省略可）
+        at：出現を始めるフレーム，type："boss"か"minion"，count：出現数，every：出現の間隔（フレーム数）
+        x，y：出現位置（カメラ左端からの座標，xは[最小, 最大]にするとその範囲でランダム）
+        vx，vy：1フレームの移動量，pattern：動き方，hp：HP，img：画像
+        fire：撃ち方（"aimed"：こうかとんを狙う，"spread"：狙った方向と左右20度の3発，"down"：真下，"none"：撃たない）
+        interval：撃つ間隔（ボスで省略すると，ボス自身がランダムに決めた間隔）
+    雑魚敵の判断（think）はbuckets組に分けて1フレームに1組ずつ行い，
+    カメラから遠く離れた雑魚敵は更新も描画もしない
+    画面に入った後でカメラから遠く離れた雑魚敵と，patienceフレーム経っても画面に入らない雑魚敵は消す
+    """
+    buckets = 4  # 雑魚敵の判断を分散させる組の数
+    margin = 300  # カメラの範囲からこれ以上離れた雑魚敵は更新も描画もしない（ピクセル）
+    patience = 500  # 一度も画面に入らないまま，このフレーム数が過ぎた雑魚敵は消す（50fpsで10秒）
+    spread = 20  # "spread"で左右に広げる角度（度）
+    lookahead = 100  # 出現のこのフレーム数前から画像を別スレッドで読んでおく
+    types = ("boss", "minion")
+    fires = ("aimed", "spread", "down", "none")
+    patterns = ("line", "sine", "homing")
+
+    def __init__(self, waves: list[dict], source: str = "ウェーブの定義"):
+        """
+        引数1 waves：ウェーブの辞書のリスト
+        引数2 source：エラーメッセージに入れる定義の出どころ（ファイル名など）
+        """
+        for i, wave in enumerate(waves):
+            __class__._check(wave, f"{source} の{i+1}番目のウェーブ")
+        self.queue: list[tuple[int, int, dict]] = []  # (出現フレーム, 順番, ウェーブ)
+        for wave in waves:
+            for i in range(wave.get("count", 1)):
+                self.queue.append((wave["at"]+i*wave.get("every", 0), len(self.queue), wave))
+        self.queue.sort(key=lambda item: item[:2])
+        self.next = 0  # 次に出現させるqueueの番号
+        self.ahead = 0  # 次に画像を先読みするqueueの番号
+        self.spawned = 0
+        self.culled = 0  # 直前のフレームで更新を飛ばした雑魚敵の数
+
+    @staticmethod
+    def _check(wave, where: str):
+        """
+        ウェーブの辞書の値を確かめる（おかしければValueError）
+        引数1 wave：ウェーブの辞書
+        引数2 where：エラーメッセージに入れる場所
+        """
+        def integer(key: str, low: int) -> bool:
+            value = wave.get(key, low)
+            return isinstance(value, int) and not isinstance(value, bool) and value >= low
+
+        if not isinstance(wave, dict):
+            raise ValueError(f"{where}：辞書にしてください")
+        if "at" not in wave or not integer("at", 0):
+            raise ValueError(f"{where}：atに出現フレーム（0以上の整数）を指定してください")
+        for key, low in (("count", 1), ("every", 0), ("interval", 1), ("hp", 1)):
+            if not integer(key, low):
+                raise ValueError(f"{where}：{key}は{low}以上の整数にしてください（{wave[key]!r}）")
+        for key, choices in (("type", __class__.types), ("fire", __class__.fires), ("pattern", __class__.patterns)):
+            if key in wave and wave[key] not in choices:
+                raise ValueError(f"{where}：{key}は{'，'.join(choices)}のどれかにしてください（{wave[key]!r}）")
+        x = wave.get("x")
+        if x is not None and not (isinstance(x, (int, float)) or
+                                  isinstance(x, list) and len(x) == 2 and all(isinstance(v, int) for v in x)):
+            raise ValueError(f"{where}：xは数か[最小, 最大]の整数の組にしてください（{x!r}）")
+
+    @classmethod
+    def load(cls, path: str) -> "WaveScheduler":
+        """
+        ステージ定義のJSONファイル（{"waves": [...]}）を読み込む（内容がおかしければValueError）
+        """
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict) or not isinstance(data.get("waves"), list):
+            raise ValueError(f"{path} に\"waves\"のリストがありません")
+        return cls(data["waves"], path)
+
+    @property
+    def done(self) -> bool:
+        """
+        全てのウェーブを出現させ終わったか
+        """
+        return self.next >= len(self.queue)
+
+    def spawn(self, game: "Game"):
+        """
+        出現フレームになった敵を出現させる
+        """
+        rng = game.rng
+        left = game.view.left
+        while self.ahead < len(self.queue) and self.queue[self.ahead][0] <= game.tmr+__class__.lookahead:
+            wave = self.queue[self.ahead][2]
+            self.ahead += 1
+            if wave.get("type", "minion") != "boss":
+                ASSETS.prefetch([wave.get("img", "fig/alien1.png")])
+        while self.next < len(self.queue) and self.queue[self.next][0] <= game.tmr:
+            wave = self.queue[self.next][2]
+            self.next += 1
+            x = wave.get("x")
+            if isinstance(x, list):
+                x = rng.randint(*x)
+            if wave.get("type", "minion") == "boss":
+                emy = Boss(rng)
+                if x is not None:
+                    emy.rect.centerx = left+x
+                emy.interval = wave.get("interval", emy.interval)
+                emy.fire = wave.get("fire", emy.fire)
+            else:
+                emy = Minion((left+(x if x is not None else WIDTH//2), wave.get("y", -40)),
+                             (wave.get("vx", 0), wave.get("vy", 2)), wave.get("pattern", "line"), wave.get("hp", 2),
+                             wave.get("fire", "aimed"), wave.get("interval", 90), wave.get("img", "fig/alien1.png"))
+                emy.bucket = self.spawned%__class__.buckets
+            self.spawned += 1
+            game.spawn(game.emys, emy)
+
+    def update(self, game: "Game", area: pg.Rect):
+        """
+        敵を更新する
+        雑魚敵は，カメラから遠いものは更新も描画もせず，自分の組の番のフレームだけ判断させる
+        画面に入った後で遠くへ出ていった（カメラに置いていかれた）雑魚敵と，いつまでも画面に入らない雑魚敵は消す
+        """
+        near = area.inflate(2*__class__.margin, 2*__class__.margin)
+        turn = game.tmr%__class__.buckets
+        bird = game.bird
+        self.culled = 0
+        for emy in game.emys.sprites():
+            if not isinstance(emy, Minion):
+                emy.update(area)
+                continue
+            if not emy.entered:
+                emy.waited += 1
+                if emy.waited > __class__.patience:
+                    emy.kill()
+                    continue
+            if not near.colliderect(emy.rect):
+                if emy.entered:
+                    emy.kill()
+                    continue
+                emy.visible = 0
+                self.culled += 1
+                continue
+            emy.visible = 1
+            if emy.bucket == turn:
+                emy.think(bird)
+            emy.update(area)
+            if emy.entered and not near.colliderect(emy.rect):
+                emy.kill()
+
+    def _dirs(self, emy, bird: Bird) -> list[tuple[float, float] | None]:
+        """
+        撃つ爆弾の向きのリスト（Noneはこうかとんを狙う）
+        """
+        if emy.fire == "down":
+            return [(0.0, 1.0)]
+        if emy.fire == "spread":
+            vx, vy = calc_orientation(emy.rect, bird.rect)
+            dirs = []
+            for deg in (-__class__.spread, 0, __class__.spread):
+                rad = math.radians(deg)
+                dirs.append((vx*math.cos(rad)-vy*math.sin(rad), vx*math.sin(rad)+vy*math.cos(rad)))
+            return dirs
+        return [None]
+
+    def fire(self, game: "Game"):
+        """
+        撃つ間隔のフレームになった敵に爆弾を撃たせる
+        """
+        tmr = game.tmr
+        firing = [emy for emy in game.emys
+                  if emy.fire != "none" and tmr%emy.interval == 0 and emy.can_fire(game.view)]
+        if not firing:
+            return
+        bird = game.bird
+        rng = game.rng
+        if game.bomb_arr is not None:
+            # こうかとんを狙う分はまとめて生成し，それ以外は向きを決めて生成する
+            origins = [(emy.rect.centerx, emy.rect.centery+emy.rect.height//2) for emy in firing if emy.fire == "aimed"]
+            if origins:
+                game.bomb_arr.aim(origins, bird.rect.center, 15, [rng.randrange(len(Bomb.colors)) for _ in origins])
+            for emy in firing:
+                if emy.fire != "aimed":
+                    for vx, vy in self._dirs(emy, bird):
+                        game.bomb_arr.spawn((emy.rect.centerx, emy.rect.centery+emy.rect.height//2),
+                                            (15*vx, 15*vy), rng.randrange(len(Bomb.colors)))
+            return
+        for emy in firing:
+            for d in self._dirs(emy, bird):
+                bomb = game.pools[Bomb].acquire(emy, bird, rng)
+                if bomb is not None and d is not None:
+                    bomb.vx, bomb.vy = d
+                game.spawn(game.bombs, bomb)
+
+
+DEFAULT_WAVES = [{"at": 0, "type": "boss", "interval": 30}]  # ステージ定義を指定しないときはボス1体
+
 
 class Score:
     """
@@ -327,13 +1402,25 @@ class Score:
         self.font = pg.font.Font(None, 50)
         self.color = (0, 0, 255)
         self.value = 0
+        self.shown = self.value  # 描画済みの値
         self.image = self.font.render(f"Score: {self.value}", 0, self.color)
         self.rect = self.image.get_rect()
         self.rect.center = 100, HEIGHT-50
 
-    def update(self, screen: pg.Surface):
+    def render(self) -> bool:
+        """
+        スコアが変わったときだけ文字列を描き直す
+        戻り値：描き直したかどうか
+        """
+        if self.value == self.shown:
+            return False
+        self.shown = self.value
         self.image = self.font.render(f"Score: {self.value}", 0, self.color)
-        screen.blit(self.image, self.rect)
+        return True
+
+    def update(self, screen: pg.Surface):
+        self.render()
+        return screen.blit(self.image, self.rect)
 
 class Chargejudge:
     """
@@ -343,63 +1430,143 @@ class Chargejudge:
         self.font = pg.font.Font(None, 50)
         self.color = (0, 0, 255)
         self.value = 0  # フレーム数
-        self.image = self.font.render("Charge:Hold SPACE", 0, self.color)
+        self.text = "Charge:Hold SPACE"  # 描画済みの文字列
+        self.image = self.font.render(self.text, 0, self.color)
         self.rect = self.image.get_rect()
         self.rect.center = 900, HEIGHT-50
 
-    def update(self, screen: pg.Surface):
+    def render(self) -> bool:
+        """
+        表示する文字列が変わったときだけ描き直す
+        戻り値：描き直したかどうか
+        """
         if self.value >= 60:  # フレーム数が60以上だったら
-            self.image = self.font.render("Charge 100%", 0, self.color)
+            text = "Charge 100%"
         elif 10 <= self.value < 60:  # フレーム数が10以上60未満だったら
-            self.image = self.font.render(f"Charging…{int(self.value/60*100)}%", 0, self.color)
+            text = f"Charging…{int(self.value/60*100)}%"
         else:
-            self.image = self.font.render("Charge:Hold SPACE", 0, self.color)
-        screen.blit(self.image, self.rect)
+            text = "Charge:Hold SPACE"
+        if text == self.text:
+            return False
+        self.text = text
+        self.image = self.font.render(text, 0, self.color)
+        return True
+
+    def update(self, screen: pg.Surface):
+        self.render()
+        return screen.blit(self.image, self.rect)
 
 class Hpbar:
     """
     HPバーを表示するクラス
+    枠と目盛りは起動時に一度だけ描いておき，HPが変わったときだけ中身を塗り直す
     """
     def __init__(self, obj:Bird):
         self.obj = obj
         self.max = self.obj.hp  # HPの初期値を取得
+        top = 215-(self.max//2-1)*4  # 一番上の目盛りのy座標
+        self.rect = pg.Rect(20, top, 20, 20+self.max*2-top)
+        # 枠と目盛りだけのSurface（黒は透過）
+        self.frame = pg.Surface(self.rect.size)
+        self.frame.set_colorkey((0, 0, 0))
+        pg.draw.rect(self.frame, (125, 50, 50), (0, 20-top, 20, self.max*2), 1)
+        for i in range(self.max//2):
+            pg.draw.rect(self.frame, (125, 50, 50), (0, 215-i*4-top, 20, 2), 1)
+        self.image = pg.Surface(self.rect.size, pg.SRCALPHA)
+        self.shown = None  # 描画済みのHP
+        self.render()
+
+    def render(self) -> bool:
+        """
+        HPが変わったときだけバーの中身を塗り直す
+        戻り値：描き直したかどうか
+        """
+        hp = max(0, min(self.obj.hp, self.max))
+        if hp == self.shown:
+            return False
+        self.shown = hp
+        y0 = 20-self.rect.top  # バー本体の上端
+        diff = self.max - hp
+        self.image.fill((0, 0, 0, 0))
+        self.image.fill((255, 0, 0), (0, y0, 20, self.max*2))
+        self.image.fill((0, 255, 0), (0, y0+2*diff, 20, hp*2))
+        self.image.blit(self.frame, (0, 0))
+        return True
 
     def update(self, screen:pg.Surface):
-        diff = (self.max - self.obj.hp)
         # 画面左側にHPバーを描画
-        pg.draw.rect(screen, (255, 0, 0), (20, 20, 20, self.max*2))
-        pg.draw.rect(screen, (0, 255, 0), (20, 20 + 2 * diff, 20, self.obj.hp*2))
-        pg.draw.rect(screen, (125, 50, 50), (20, 20, 20, self.max*2), 1)
-        for i in range(self.max//2):
-            pg.draw.rect(screen, (125, 50, 50), (20, 215-i*4, 20, 2), 1)
+        self.render()
+        return screen.blit(self.image, self.rect)
 
-class HealItem(pg.sprite.Sprite):
+class Hud:
+    """
+    スコア，チャージ表示，HPバーをまとめて描画するクラス
+    各要素は値が変わったときだけ描き直し，画面へは1回のblitsでまとめて転送する
+    """
+    def __init__(self, *parts: "Score|Chargejudge|Hpbar"):
+        self.parts = parts
+        self.every = 1  # 何フレームに一度，値の変化を見て描き直すか（間は前の画像のまま）
+        self.frame = 0
+
+    def update(self, screen: pg.Surface) -> list[pg.Rect]:
+        """
+        HUDを描画する
+        引数 screen：画面Surface
+        戻り値：描画した範囲のリスト
+        """
+        self.frame += 1
+        if self.frame%self.every == 0:
+            for part in self.parts:
+                part.render()
+        return screen.blits([(part.image, part.rect) for part in self.parts])
+
+class HealItem(pg.sprite.DirtySprite):
     """
     回復アイテムに関するクラス
     """
-    def __init__(self):
+    margin = 300  # ステージでカメラの範囲からこれ以上離れたら消す（ピクセル）
+
+    def __init__(self, rng: random.Random = random, area: pg.Rect | None = None):
         """
         回復アイテムをランダムなx座標の画面上端に生成する
         大きさと回復量と落下速度が比例していて、その値はランダムで決まる（5段階）
+        引数1 rng：大きさと位置を決める乱数生成器
+        引数2 area：出現させる範囲（Noneなら画面，ステージではカメラに映っている範囲）
         """
         super().__init__()
-        self.random_num = random.randint(1, 5)
+        self.dirty = 2
+        self.random_num = rng.randint(1, 5)
         self.heal_num = self.random_num*10
-        self.image = pg.transform.rotozoom(pg.image.load(f"fig/0.png"), 0, 0.5+(self.random_num/10))
+        self.scale = 0.5+(self.random_num/10)
+        self.flip = False  # 左右反転しているか
+        self.flips = 0  # 反転する位置に来た回数
+        self.image = ASSETS.variant("fig/0.png", 0, self.scale)
         self.rect = self.image.get_rect()
-        self.rect.center = random.randint(0, WIDTH), 0
+        self.rect.center = rng.randint(0, WIDTH)+(0 if area is None else area.left), 0
         self.vx, self.vy = 0, 1 + self.random_num/2
 
-    def update(self):
+    def update(self, stage: Stage | None = None, area: pg.Rect | None = None, flip_every: int = 1):
         """
         回復アイテムを速度ベクトルself.vyに基づき反転させながら落下させる
         画面端に到達したらself.kill()でインスタンスを削除する
+        引数1 stage：ステージ（あれば地形の上に着地して止まる）
+        引数2 area：カメラに映っている範囲（ここからmargin以上離れたら，着地したものも消す）
+        引数3 flip_every：反転する位置に何回来たら実際に反転させるか（見た目の質を下げるときに増やす）
         """
-        if self.rect.centery/10%2 == 0:
-            self.image = pg.transform.flip(self.image, True, False)
+        if area is not None and not area.inflate(2*__class__.margin, 2*__class__.margin).colliderect(self.rect):
+            self.kill()
+            return
+        if self.vy != 0 and self.rect.centery/10%2 == 0:
+            self.flips += 1
+            if self.flips%flip_every == 0:
+                self.flip = not self.flip
+                self.image = ASSETS.variant("fig/0.png", 0, self.scale, (self.flip, False))
         if self.rect.centery > HEIGHT:
             self.kill()
         self.rect.move_ip(self.vx, self.vy)
+        if stage is not None and self.vy != 0 and stage.collide(self.rect):
+            self.rect.bottom = self.rect.bottom//Stage.TILE*Stage.TILE
+            self.vy = 0
 
     def heal(self, bird: Bird):
         """
@@ -411,146 +1578,1399 @@ class HealItem(pg.sprite.Sprite):
         else:
             bird.hp = mx_hp
 
-def main():
-    pg.display.set_caption("真！こうかとん無双")
-    screen = pg.display.set_mode((WIDTH, HEIGHT))
-    bg_img = pg.image.load(f"fig/stage3.png")
-    score = Score()
-    c_judge = Chargejudge()
-
-    bird = Bird(3, (WIDTH/4, HEIGHT))
-    hpbar = Hpbar(bird)
-    bombs = pg.sprite.Group()
-    beams = pg.sprite.Group()
-    c_beams = pg.sprite.Group()
-    exps = pg.sprite.Group()
-    emys = pg.sprite.Group()
-    healitems = pg.sprite.Group()
-
-    tmr = 0
-    i_tmr = 0
-    judge = False  # チャージしているか判定する。初期値False
-    clock = pg.time.Clock()
+class ProjectileArrays:
+    """
+    大量の弾をNumPy配列でまとめて扱うクラス（爆弾とビームの配列版）
+    中心座標，速度，見た目の番号（爆弾の色やビームの向き）を配列で持ち，
+    移動・画面外の削除・当たり判定を配列演算で一度に行う
+    見た目は番号ごとの共有Surfaceで描く
+    """
+    def __init__(self, imgs: list[pg.Surface], capacity: int = 4096):
+        """
+        引数1 imgs：見た目の番号ごとのSurface
+        引数2 capacity：同時に存在できる弾の数の上限（超えた分は生成しない）
+        """
+        self.imgs = imgs
+        self.half = np.array([(img.get_width()/2, img.get_height()/2) for img in imgs])  # 番号ごとの半径（縦横の半分）
+        self.capacity = capacity
+        self.pos = np.zeros((capacity, 2))  # 中心座標
+        self.vel = np.zeros((capacity, 2))  # 1フレームの移動量
+        self.kind = np.zeros(capacity, dtype=np.intp)  # 見た目の番号
+        self.n = 0  # 存在する弾の数（配列の先頭n個が有効）
+        self.dropped = 0  # 上限を超えて生成しなかった数
 
-    emys.add(Boss()) # 敵の呼び出し
+    def __len__(self) -> int:
+        return self.n
 
-    while True:
+    def spawn(self, pos, vel, kind):
+        """
+        弾をまとめて追加する
+        引数1 pos：中心座標の配列（k×2）
+        引数2 vel：1フレームの移動量の配列（k×2）
+        引数3 kind：見た目の番号の配列（k）
+        """
+        pos, vel, kind = np.atleast_2d(pos), np.atleast_2d(vel), np.atleast_1d(kind)
+        k = min(len(pos), self.capacity-self.n)
+        self.dropped += len(pos)-k
+        n = self.n
+        self.pos[n:n+k] = pos[:k]
+        self.vel[n:n+k] = vel[:k]
+        self.kind[n:n+k] = kind[:k]
+        self.n += k
+
+    def aim(self, origins, target: tuple[float, float], speed: float, kind):
+        """
+        複数の発射位置からtargetへ向かう弾をまとめて追加する（calc_orientationの配列版）
+        引数1 origins：発射位置の配列（k×2）
+        引数2 target：狙う座標
+        引数3 speed：弾の速さ
+        引数4 kind：見た目の番号の配列（k）
+        """
+        origins = np.atleast_2d(np.asarray(origins, dtype=float))
+        diff = np.asarray(target, dtype=float)-origins
+        norm = np.hypot(diff[:, 0], diff[:, 1])
+        diff[norm == 0] = 0, 1  # 中心が重なっているときは真下（calc_orientationと同じ）
+        norm[norm == 0] = 1
+        self.spawn(origins, diff/norm[:, None]*speed, kind)
+
+    def _keep(self, mask):
+        """
+        maskがTrueの弾だけを残して配列を詰める
+        """
+        m = int(mask.sum())
+        n = self.n
+        self.pos[:m] = self.pos[:n][mask]
+        self.vel[:m] = self.vel[:n][mask]
+        self.kind[:m] = self.kind[:n][mask]
+        self.n = m
+
+    def update(self, area: pg.Rect | None = None):
+        """
+        全ての弾を移動させ，範囲から出た弾を消す（check_boundの配列版）
+        引数 area：この範囲から出たら消す（Noneなら画面）
+        """
+        left, top, right, bottom = (0, 0, WIDTH, HEIGHT) if area is None else (area.left, area.top, area.right, area.bottom)
+        n = self.n
+        pos = self.pos[:n]
+        pos += self.vel[:n]
+        half = self.half[self.kind[:n]]
+        lo, hi = pos-half, pos+half
+        inside = (lo[:, 0] >= left) & (lo[:, 1] >= top) & (hi[:, 0] <= right) & (hi[:, 1] <= bottom)
+        if not inside.all():
+            self._keep(inside)
+
+    def _overlap(self, left, top, right, bottom):
+        """
+        各弾の矩形が指定の矩形（配列可）と重なるかの真理値配列を返す
+        """
+        n = self.n
+        pos = self.pos[:n]
+        half = self.half[self.kind[:n]]
+        return ((pos[:, 0]-half[:, 0] < right) & (pos[:, 0]+half[:, 0] > left) &
+                (pos[:, 1]-half[:, 1] < bottom) & (pos[:, 1]+half[:, 1] > top))
+
+    def hits(self, rct: pg.Rect):
+        """
+        rctと重なっている弾の番号の配列を返す
+        """
+        return np.flatnonzero(self._overlap(rct.left, rct.top, rct.right, rct.bottom))
+
+    def pair_hits(self, other: "ProjectileArrays"):
+        """
+        別の弾の配列との総当たりの当たり判定を行う
+        戻り値：(当たったself側の番号の配列，当たったother側の番号の配列)
+        """
+        if self.n == 0 or other.n == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        o_pos = other.pos[:other.n]
+        o_half = other.half[other.kind[:other.n]]
+        lo, hi = o_pos-o_half, o_pos+o_half
+        n = self.n
+        pos = self.pos[:n, :, None]  # n×2×1 と 2×m で総当たり
+        half = self.half[self.kind[:n]][:, :, None]
+        hit = ((pos[:, 0]-half[:, 0] < hi[:, 0]) & (pos[:, 0]+half[:, 0] > lo[:, 0]) &
+               (pos[:, 1]-half[:, 1] < hi[:, 1]) & (pos[:, 1]+half[:, 1] > lo[:, 1]))
+        return np.flatnonzero(hit.any(axis=1)), np.flatnonzero(hit.any(axis=0))
+
+    def centers(self, idx) -> list[tuple[int, int]]:
+        """
+        指定した弾の中心座標のリストを返す
+        """
+        return [tuple(p) for p in self.pos[idx].astype(int).tolist()]
+
+    def remove(self, idx):
+        """
+        指定した番号の弾を消す
+        """
+        if len(idx) == 0:
+            return
+        mask = np.ones(self.n, dtype=bool)
+        mask[idx] = False
+        self._keep(mask)
+
+    def draw(self, screen: pg.Surface, alpha: float = 1.0, doreturn: bool = False, cam_x: float = 0):
+        """
+        全ての弾を共有Surfaceから1回のblitsで描画する
+        引数1 screen：画面Surface
+        引数2 alpha：直前のstepから次のstepまでの経過割合（1.0未満なら速度から位置を補間する）
+        引数3 doreturn：Trueなら描画した範囲のリストを返す
+        引数4 cam_x：カメラの左端のx座標（ステージのスクロール分ずらして描く）
+        """
+        n = self.n
+        topleft = self.pos[:n]-self.half[self.kind[:n]]-(cam_x, 0)
+        if alpha < 1.0:
+            topleft = topleft-self.vel[:n]*(1.0-alpha)
+        imgs = self.imgs
+        return screen.blits(list(zip([imgs[k] for k in self.kind[:n].tolist()], topleft.astype(int).tolist())),
+                            doreturn=doreturn)
+
+
+class FrameProfiler:
+    """
+    フレーム内の各処理にかかった時間を計測するクラス
+    処理の区切りでlap(名前)を呼ぶと，前の区切りからの経過時間がその名前に加算される
+    直近windowフレーム分からp50／p95／p99を求め，オーバーレイ表示やCSV／JSONへの書き出しを行う
+    """
+    def __init__(self, enabled: bool = True, window: int = 300, max_rows: int = 200000):
+        """
+        引数1 enabled：Falseなら何も計測しない
+        引数2 window：パーセンタイルを求める直近のフレーム数
+        引数3 max_rows：書き出し用に保持するフレーム数の上限
+        """
+        self.enabled = enabled
+        self.window = window
+        self.max_rows = max_rows
+        self.visible = False  # オーバーレイを表示するか
+        self.frame = 0
+        self.t0 = self.last = time.perf_counter()
+        self.blocks = sys.getallocatedblocks()
+        self.cur: dict[str, float] = {}  # 今のフレームの処理ごとの時間（秒）
+        self.hist: dict[str, deque[float]] = {}  # 処理ごとの直近の時間（ミリ秒）
+        self.counts: dict[str, int] = {}  # 直近のフレームのスプライト数など
+        self.rows: list[dict[str, float]] = []  # 書き出し用のフレームごとの記録
+        self.font = None
+        self.overlay: pg.Surface | None = None
+
+    def begin_frame(self):
+        """
+        フレームの計測を始める
+        """
+        if not self.enabled:
+            return
+        self.t0 = self.last = time.perf_counter()
+        self.blocks = sys.getallocatedblocks()
+        self.cur = {}
+
+    def lap(self, name: str):
+        """
+        前の区切りからの経過時間をnameの処理時間として加算する
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.cur[name] = self.cur.get(name, 0.0)+now-self.last
+        self.last = now
+
+    def end_frame(self, counts: dict[str, int] | None = None):
+        """
+        フレームの計測を終え，記録に加える
+        引数 counts：グループごとのスプライト数など，フレームごとに記録したい値
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        row = {name: sec*1000 for name, sec in self.cur.items()}
+        row["frame"] = (now-self.t0)*1000
+        row["work"] = row["frame"]-row.get("wait", 0.0)  # 待ち時間を除いた処理時間
+        row["alloc"] = sys.getallocatedblocks()-self.blocks  # このフレームで増えたメモリブロック数
+        for name, ms in row.items():
+            if name not in self.hist:
+                self.hist[name] = deque(maxlen=self.window)
+            self.hist[name].append(ms)
+        if counts:
+            self.counts = counts
+            row.update({f"n_{name}": n for name, n in counts.items()})
+        if len(self.rows) < self.max_rows:
+            self.rows.append({"i": self.frame, **row})
+        self.frame += 1
+
+    def percentiles(self, name: str) -> tuple[float, float, float]:
+        """
+        直近windowフレームでのnameの処理時間のp50，p95，p99（ミリ秒）を返す
+        """
+        vals = sorted(self.hist.get(name, ()))
+        if not vals:
+            return 0.0, 0.0, 0.0
+        pick = lambda q: vals[min(len(vals)-1, int(q*len(vals)))]
+        return pick(0.50), pick(0.95), pick(0.99)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """
+        処理ごとのp50／p95／p99と平均をまとめた辞書を返す
+        """
+        out = {}
+        for name, vals in self.hist.items():
+            p50, p95, p99 = self.percentiles(name)
+            out[name] = {"p50": p50, "p95": p95, "p99": p99, "mean": sum(vals)/len(vals)}
+        return out
+
+    def draw_overlay(self, screen: pg.Surface) -> pg.Rect | None:
+        """
+        計測結果を画面右上に表示する（10フレームごとに描き直す）
+        引数 screen：画面Surface
+        戻り値：描画した範囲（非表示ならNone）
+        """
+        if not (self.enabled and self.visible):
+            return None
+        if self.overlay is None or self.frame%10 == 0:
+            if self.font is None:
+                self.font = pg.font.Font(None, 20)
+            lines = ["name          p50    p95    p99 (ms)"]
+            for name in sorted(self.hist, key=lambda n: (n != "frame", n != "work", n)):
+                if name == "alloc":
+                    continue
+                p50, p95, p99 = self.percentiles(name)
+                lines.append(f"{name:<12}{p50:6.2f} {p95:6.2f} {p99:6.2f}")
+            p50, p95, p99 = self.percentiles("alloc")
+            lines.append(f"alloc blocks {p50:+.0f} {p95:+.0f} {p99:+.0f}")
+            lines.append(" ".join(f"{name}:{n}" for name, n in self.counts.items()))
+            imgs = [self.font.render(line, True, (255, 255, 255)) for line in lines]
+            self.overlay = pg.Surface((max(img.get_width() for img in imgs)+10, 16*len(imgs)+10))
+            self.overlay.set_alpha(200)
+            for i, img in enumerate(imgs):
+                self.overlay.blit(img, (5, 5+16*i))
+        return screen.blit(self.overlay, self.overlay.get_rect(topright=(WIDTH-10, 10)))
+
+    def dump(self, path: str, extra: dict | None = None):
+        """
+        計測結果をファイルに書き出す
+        拡張子が.csvならフレームごとの記録を，それ以外はまとめと記録をJSONで書き出す
+        引数1 path：書き出すファイルのパス
+        引数2 extra：JSONに一緒に書き出す値（プールやキャッシュの統計など）
+        """
+        if path.endswith(".csv"):
+            names = list(dict.fromkeys(name for row in self.rows for name in row))
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=names, restval=0)
+                writer.writeheader()
+                writer.writerows(self.rows)
+            return
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), **(extra or {}), "frames": self.rows}, f)
+
+
+class Telemetry:
+    """
+    プレイの記録（イベント）を別スレッドでファイルに書き出すクラス
+    emitはメモリ上のバッファに追加するだけで，ファイルへの書き込み（gzip圧縮したJSONL）は
+    書き込み用のスレッドがflush_every秒ごとにまとめて行うので，ゲームループがディスクを待つことはない
+    バッファがcapacity件に達している間（書き込みが追いつかないとき）のイベントは捨てて数だけ数え，
+    最後の"telemetry"イベントに記録する
+    pathがNoneなら何もしない
+    """
+    def __init__(self, path: str | None, capacity: int = 8192, flush_every: float = 0.5):
+        """
+        引数1 path：書き出すファイル（.gzで終わればgzip圧縮，Noneなら記録しない）
+        引数2 capacity：バッファに溜められるイベント数の上限
+        引数3 flush_every：書き出しの間隔（秒）
+        """
+        self.enabled = path is not None
+        self.capacity = capacity
+        self.flush_every = flush_every
+        self.buf: deque[dict] = deque()  # appendとpopleftはスレッド間で安全に使える
+        self.emitted = 0
+        self.dropped = 0
+        self.written = 0
+        self.frame = 0  # イベントに付けるフレーム番号（Gameが更新する）
+        if not self.enabled:
+            return
+        self.file = gzip.open(path, "wt", encoding="utf-8") if path.endswith(".gz") else open(path, "w", encoding="utf-8")
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+        self.thread.start()
+
+    def emit(self, ev: str, **fields):
+        """
+        イベントを1つ記録する（バッファが一杯なら捨てる）
+        引数1 ev：イベントの種類
+        引数2 fields：イベントの内容（JSONにできる値）
+        """
+        if not self.enabled:
+            return
+        if len(self.buf) >= self.capacity:
+            self.dropped += 1
+            return
+        fields["t"] = self.frame
+        fields["ev"] = ev
+        self.buf.append(fields)
+        self.emitted += 1
+
+    def _drain(self):
+        """
+        バッファにあるイベントを全てファイルに書く（書き込み用のスレッドで呼ぶ）
+        """
+        buf = self.buf
+        lines = []
+        while buf:
+            lines.append(json.dumps(buf.popleft(), ensure_ascii=False, separators=(",", ":")))
+        if lines:
+            self.file.write("\n".join(lines)+"\n")
+            self.written += len(lines)
+
+    def _run(self):
+        """
+        書き込み用のスレッドの本体
+        """
+        while not self.stop.wait(self.flush_every):
+            self._drain()
+
+    def close(self):
+        """
+        書き込み用のスレッドを止め，残りと捨てた数を書いてファイルを閉じる
+        """
+        if not self.enabled:
+            return
+        self.stop.set()
+        self.thread.join()
+        self._drain()
+        self.buf.append({"t": self.frame, "ev": "telemetry", "emitted": self.emitted, "dropped": self.dropped,
+                         "written": self.written})
+        self._drain()
+        self.file.close()
+        self.enabled = False
+
+
+class QualityGovernor:
+    """
+    直近のフレームの処理時間を見て，重いときは見た目だけの処理を段階的に減らし，余裕ができたら戻すクラス
+    ゲームの進行（step）には手を付けないので，遅い機械でもゲームの速さは変わらない
+    レベル（Game.set_qualityを参照）
+        0：全て
+        1：爆発のアニメーションを止めて描く数を抑え，回復アイテムの反転を減らす
+        2：さらに位置の補間をやめ，HUDの描き直しを5フレームに一度にする
+        3：さらに描画を2フレームに一度にする
+    行ったり来たりしないよう，下げるのは重い状態がdown_afterフレーム続いたとき，
+    上げるのは十分に軽い状態がup_afterフレーム続いたときだけにする（その間の負荷では何もしない）
+    """
+    max_level = 3
+
+    def __init__(self, budget_ms: float, window: int = 30, high: float = 0.9, low: float = 0.5,
+                 down_after: int = 30, up_after: int = 150, fixed: int | None = None):
+        """
+        引数1 budget_ms：1フレームに使える時間（ミリ秒）
+        引数2 window：処理時間の平均をとるフレーム数
+        引数3 high：平均がbudget_msのこの割合を超えたら重いとみなす
+        引数4 low：平均がbudget_msのこの割合を下回ったら軽いとみなす
+        引数5 down_after：重い状態がこのフレーム数続いたらレベルを1つ上げる（質を下げる）
+        引数6 up_after：軽い状態がこのフレーム数続いたらレベルを1つ下げる（質を戻す）
+        引数7 fixed：レベルを固定する（Noneなら自動）
+        """
+        self.budget = budget_ms
+        self.times: deque[float] = deque(maxlen=window)
+        self.high = high
+        self.low = low
+        self.down_after = down_after
+        self.up_after = up_after
+        self.fixed = fixed
+        self.level = fixed or 0
+        self.over = 0  # 重い状態が続いたフレーム数
+        self.under = 0  # 軽い状態が続いたフレーム数
+        self.frame = 0
+        self.log: list[dict] = []  # レベルを変えた記録
+
+    def observe(self, work_ms: float, behind: bool = False) -> bool:
+        """
+        1フレーム分の処理時間を記録し，必要ならレベルを変える
+        引数1 work_ms：待ち時間を除いたフレームの処理時間（ミリ秒）
+        引数2 behind：シミュレーションが追いつけずに時間を捨てたか
+        戻り値：レベルを変えたかどうか
+        """
+        self.frame += 1
+        if self.fixed is not None:
+            return False
+        self.times.append(work_ms)
+        avg = sum(self.times)/len(self.times)
+        if behind or avg > self.high*self.budget:
+            self.over += 1
+            self.under = 0
+        elif avg < self.low*self.budget:
+            self.under += 1
+            self.over = 0
+        else:  # 中間では数え直す（ヒステリシス）
+            self.over = self.under = 0
+        if self.over >= self.down_after and self.level < __class__.max_level:
+            self._set(self.level+1, avg)
+            return True
+        if self.under >= self.up_after and self.level > 0:
+            self._set(self.level-1, avg)
+            return True
+        return False
+
+    def _set(self, level: int, avg: float):
+        """
+        レベルを変えて記録する
+        """
+        self.log.append({"frame": self.frame, "sec": time.perf_counter()-START, "from": self.level, "to": level,
+                         "avg_ms": avg})
+        self.level = level
+        self.over = self.under = 0
+        self.times.clear()  # 変えた後の処理時間で判断し直す
+
+
+class Inputs:
+    """
+    1フレーム分の入力をまとめたクラス
+    """
+    keys = (pg.K_LEFT, pg.K_RIGHT, pg.K_UP)  # ゲームで使うキー
+
+    def __init__(self, pressed: dict[int, bool] | None = None, space: tuple[str, ...] = (), quit: bool = False,
+                 overlay: bool = False):
+        """
+        引数1 pressed：押下キーの辞書（キー：真理値）
+        引数2 space：そのフレームに起きたスペースキーのイベント（"down"／"up"）を順に並べたタプル
+        引数3 quit：ウィンドウが閉じられたか
+        引数4 overlay：計測オーバーレイの表示切り替えキー（F3）が押されたか
+        """
+        self.pressed = {k: False for k in __class__.keys}
+        if pressed is not None:
+            self.pressed.update(pressed)
+        self.space = space
+        self.quit = quit
+        self.overlay = overlay
+
+    @classmethod
+    def poll(cls) -> "Inputs":
+        """
+        キーボードとイベントキューから現在の入力を読み取る
+        """
         key_lst = pg.key.get_pressed()
+        space = []
+        quit = False
+        overlay = False
         for event in pg.event.get():
             if event.type == pg.QUIT:
-                return 0
-            if event.type == pg.KEYDOWN and event.key == pg.K_SPACE: # スペースを押したら
-                judge = True
-                c_tmr = 0  # チャージのタイマーを定義。初期値0
-            if event.type == pg.KEYUP and event.key == pg.K_SPACE:  # スペースを離したら
-                if c_tmr >= 60:  # 60以上なら
-                    c_beams.add(Chargebeam(bird, c_tmr))  # Chargebeamクラスに送る
-                else:
-                    beams.add(Beam(bird, 0))  # Beamクラスに送る
-                judge = False
+                quit = True
+            if event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                overlay = True
+            if event.type == pg.KEYDOWN and event.key == pg.K_SPACE:
+                space.append("down")
+            if event.type == pg.KEYUP and event.key == pg.K_SPACE:
+                space.append("up")
+        return cls({k: bool(key_lst[k]) for k in cls.keys}, tuple(space), quit, overlay)
 
-        screen.blit(bg_img, [0, 0])
-        
-        if len(emys) == 0:  
-            bird.change_img(9, screen) # こうかとん悲しみエフェクト
-            score.update(screen)
-            pg.display.update()
-            time.sleep(2)
+
+class InputRecorder:
+    """
+    stepごとの入力をコンパクトなバイナリファイルに記録するクラス
+    ファイル形式：ヘッダ（マジック"KKRP"，版数1バイト，シード8バイト，配列版かどうか1バイト，
+    ステージとウェーブのファイルの内容のハッシュ8バイト）の後に，1stepにつき1バイト
+        bit0-2：左，右，上キーの押下
+        bit3：スペースキーを押した，bit4：離した，bit5：離してから押した（順序）
+        bit7：上のビットで表せないイベント列のとき立て，続く1バイトに個数，その後に1イベント1バイト（0:押す，1:離す）
+    書き込みはメモリ上にためて一定量ごとにまとめて行い，ゲームループでの入出力待ちを減らす
+    """
+    header = struct.Struct("<4sBQ?8s")
+    magic = b"KKRP"
+    version = 2
+
+    def __init__(self, path: str, seed: int, soa: bool = False, stage: str | None = None, waves: str | None = None,
+                 buffer: int = 4096):
+        """
+        引数1 path：記録するファイルのパス
+        引数2 seed：記録するゲームの乱数のシード（0以上2**64未満）
+        引数3 soa：記録するゲームが配列版か
+        引数4 stage：記録するゲームのステージファイル
+        引数5 waves：記録するゲームの敵の出現を定義したJSONファイル
+        引数6 buffer：ここまでたまったらファイルに書き出すバイト数
+        """
+        if not 0 <= seed < 2**64:
+            raise ValueError(f"記録できるシードは0以上2**64未満です：{seed}")
+        self.file = open(path, "wb")
+        self.buf = bytearray(__class__.header.pack(__class__.magic, __class__.version, seed, soa,
+                                                   __class__.digest(stage, waves)))
+        self.buffer = buffer
+        self.frames = 0
+
+    @staticmethod
+    def digest(stage: str | None, waves: str | None) -> bytes:
+        """
+        ステージとウェーブのファイルの内容から8バイトのハッシュを求める（パスが違っても内容が同じなら同じ値）
+        """
+        h = hashlib.blake2b(digest_size=8)
+        for path in (stage, waves):
+            if path is None:
+                h.update(b"\0")
+            else:
+                with open(path, "rb") as f:
+                    data = f.read()
+                h.update(b"\1"+len(data).to_bytes(8, "little")+data)
+        return h.digest()
+
+    @staticmethod
+    def encode(inputs: "Inputs") -> bytes:
+        """
+        1step分の入力をバイト列にする
+        """
+        bits = 0
+        for i, k in enumerate(Inputs.keys):
+            if inputs.pressed[k]:
+                bits |= 1 << i
+        space = inputs.space
+        if space == ():
+            return bytes((bits,))
+        if space == ("down",):
+            return bytes((bits | 0x08,))
+        if space == ("up",):
+            return bytes((bits | 0x10,))
+        if space == ("down", "up"):
+            return bytes((bits | 0x18,))
+        if space == ("up", "down"):
+            return bytes((bits | 0x38,))
+        return bytes((bits | 0x80, len(space), *(0 if ev == "down" else 1 for ev in space)))
+
+    def record(self, inputs: "Inputs"):
+        """
+        1step分の入力を記録する
+        """
+        self.buf += __class__.encode(inputs)
+        self.frames += 1
+        if len(self.buf) >= self.buffer:
+            self.file.write(self.buf)
+            self.buf.clear()
+
+    def close(self):
+        """
+        残りを書き出してファイルを閉じる
+        """
+        self.file.write(self.buf)
+        self.buf.clear()
+        self.file.close()
+
+
+class InputPlayer:
+    """
+    InputRecorderで記録したファイルを読み込み，stepごとの入力を順に返すクラス
+    """
+    def __init__(self, path: str):
+        """
+        引数 path：記録ファイルのパス
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < InputRecorder.header.size:
+            raise ValueError(f"{path} は入力の記録ファイルではありません")
+        magic, version, self.seed, self.soa, self.config = InputRecorder.header.unpack_from(data)
+        if magic != InputRecorder.magic:
+            raise ValueError(f"{path} は入力の記録ファイルではありません")
+        if version != InputRecorder.version:
+            raise ValueError(f"{path} は対応していない版（{version}）の記録ファイルです")
+        self.path = path
+        self.frames: list[Inputs] = []
+        i = InputRecorder.header.size
+        while i < len(data):
+            bits = data[i]
+            i += 1
+            if bits & 0x80:
+                n = data[i]
+                space = tuple("down" if ev == 0 else "up" for ev in data[i+1:i+1+n])
+                i += 1+n
+            elif bits & 0x20:
+                space = ("up", "down")
+            else:
+                space = (("down",) if bits & 0x08 else ())+(("up",) if bits & 0x10 else ())
+            pressed = {k: bool(bits & (1 << j)) for j, k in enumerate(Inputs.keys)}
+            self.frames.append(Inputs(pressed, space))
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def check(self, soa: bool, stage: str | None, waves: str | None):
+        """
+        記録したときと同じ設定で再生しようとしているかを確かめる（違えば展開が変わるのでValueErrorを出す）
+        引数1 soa：再生するゲームが配列版か
+        引数2 stage：再生するゲームのステージファイル
+        引数3 waves：再生するゲームの敵の出現を定義したJSONファイル
+        """
+        if soa != self.soa:
+            raise ValueError(f"{self.path} は--soa{'あり' if self.soa else 'なし'}で記録されています")
+        if InputRecorder.digest(stage, waves) != self.config:
+            raise ValueError(f"{self.path} は別のステージ（--stage／--waves）で記録されています")
+
+    def policy(self, game: "Game", frame: int) -> "Inputs":
+        """
+        run_headlessなどに渡す入力関数（記録が尽きたら何も押していない入力を返す）
+        """
+        return self.frames[frame] if frame < len(self.frames) else Inputs()
+
+
+class GameState:
+    """
+    ゲームの進行状態（シーン）をフレーム数のタイマーで管理する状態機械
+    "play"：プレイ中
+    "hitstop"：回復アイテムを取ったときなどの一時停止（時間が来たら"play"に戻る）
+    "over"／"clear"：ゲームオーバー／クリアの演出（時間が来たら"done"になる）
+    "done"：ゲーム終了
+    プレイ中の無敵時間もここで数える
+    """
+    durations = {"hitstop": 5, "over": 100, "clear": 100}  # 各状態の長さ（フレーム数，50fpsで0.1秒／2秒）
+
+    def __init__(self):
+        self.state = "play"
+        self.tmr = 0  # 今の状態の残りフレーム数
+        self.invincible = 0  # 無敵時間の残りフレーム数
+
+    def enter(self, state: str, frames: int | None = None):
+        """
+        状態を切り替える
+        引数1 state：新しい状態
+        引数2 frames：状態の長さ（Noneならdurationsの値）
+        """
+        self.state = state
+        self.tmr = frames if frames is not None else __class__.durations.get(state, 0)
+
+    def make_invincible(self, frames: int):
+        """
+        無敵時間を開始する
+        引数 frames：無敵時間のフレーム数
+        """
+        self.invincible = frames
+
+    def tick(self):
+        """
+        1フレーム分タイマーを進め，時間が来たら次の状態へ移る
+        無敵時間はプレイ中だけ減らす
+        """
+        if self.state == "play":
+            if self.invincible > 0:
+                self.invincible -= 1
+            return
+        if self.state == "done":
+            return
+        self.tmr -= 1
+        if self.tmr <= 0:
+            self.enter("play" if self.state == "hitstop" else "done")
+
+
+class Game:
+    """
+    ゲームの状態を持ち，1フレーム分のシミュレーション（step）と描画（draw）を行うクラス
+    stepは描画もウェイトもしないので，ウィンドウなしで実時間より速く回せる
+    """
+    def __init__(self, dirty: bool = False, max_rects: int = 60, prof: FrameProfiler | None = None,
+                 soa: bool = False, seed: int | None = None, stage: str | None = None, waves: str | None = None,
+                 tel: Telemetry | None = None):
+        """
+        引数1 dirty：Trueなら変化した矩形だけを描き直して転送する（LayeredDirtyによる描画）
+        引数2 max_rects：1フレームの変化矩形がこれを超えたら，次のフレームは画面全体を描き直す
+        引数3 prof：処理時間の計測に使うFrameProfiler（Noneなら計測しない）
+        引数4 soa：Trueなら爆弾と通常ビームをスプライトではなくNumPy配列（ProjectileArrays）で扱う
+        引数5 seed：このゲームの乱数のシード（Noneならランダムに決める）
+        引数6 stage：地形のステージファイル（Noneなら地形なしの1画面）
+        引数7 waves：敵の出現を定義したJSONファイル（Noneならボス1体）
+        引数8 tel：プレイの記録を書き出すTelemetry（Noneなら記録しない）
+        ステージではスクロールで毎フレーム画面全体が変わるので，dirty描画は使わない
+        """
+        # 乱数はすべてこのゲーム専用の生成器から取り，シードと入力が同じなら同じ展開になるようにする
+        self.seed = seed if seed is not None else random.randrange(2**32)
+        self.rng = random.Random(self.seed)
+        self.prof = prof if prof is not None else FrameProfiler(enabled=False)
+        self.tel = tel if tel is not None else Telemetry(None)
+        ASSETS.load_atlas(ATLAS)
+        ASSETS.preload(PRELOAD)
+        ASSETS.warmup(WARMUP)
+        self.score = Score()
+        self.c_judge = Chargejudge()
+
+        self.stage = Stage(stage) if stage is not None else None
+        # ステージでは背景を地形より遅く動かして奥行きを出す
+        self.bg = Background([("fig/stage3.png", 0.25 if self.stage is not None else 0)])
+        self.cam = self.prev_cam = 0  # カメラの左端のx座標（今と直前のstep開始時）
+        self.view = pg.Rect(0, 0, WIDTH, HEIGHT)  # カメラに映っている範囲（ワールド座標）
+        self.bird = Bird(3, (WIDTH/4, HEIGHT))
+        if self.stage is not None:
+            self.bird.rect.bottom = self.stage.floor(self.bird.rect)  # 地形の上に立たせる
+        self.hpbar = Hpbar(self.bird)
+        self.hud = Hud(self.score, self.c_judge, self.hpbar)
+        self.bombs = pg.sprite.Group()
+        self.beams = pg.sprite.Group()
+        self.c_beams = pg.sprite.Group()
+        self.effects = Particles()  # 爆発エフェクト
+        self.emys = pg.sprite.Group()
+        self.healitems = pg.sprite.Group()
+
+        # dirty描画では全スプライトをLayeredDirtyにも登録し，変化した矩形だけを描き直す
+        self.layers = {self.beams: 1, self.c_beams: 1, self.emys: 2, self.bombs: 3, self.healitems: 5}  # 重ね順
+        self.layered = pg.sprite.LayeredDirty() if dirty and self.stage is None else None
+        if self.layered is not None:
+            self.layered.add(self.bird, layer=0)
+        self.max_rects = max_rects
+        self.full_redraw = True  # dirty描画時に次のフレームを全画面で描き直すか
+        self.hud_rcts: list[pg.Rect] = []  # 前フレームでHUDや配列版の弾など，スプライトの上に描いた範囲
+        self.prev: dict[pg.sprite.Sprite, tuple[int, int]] = {}  # 直前のstep開始時の位置（補間描画用）
+
+        # 弾はプールから取り出して使い回す
+        self.pools = {
+            Bomb: Pool(Bomb, 300),
+            Beam: Pool(Beam, Beam.cap, "drop"),
+            Chargebeam: Pool(Chargebeam, 16, "drop"),
+        }
+
+        # 配列版の弾（見た目の番号は，爆弾は色，ビームは右向き／左向き）
+        self.bomb_arr = self.beam_arr = None
+        if soa:
+            self.bomb_arr = ProjectileArrays([Bomb.image_for(color) for color in Bomb.colors])
+            self.beam_arr = ProjectileArrays([ASSETS.variant("fig/beam.png", angle, 1.0) for angle in (0, 180)], Beam.cap)
+        # 同じ重ね順でスプライトの後に描く配列（爆発は爆弾の上，回復アイテムの下）
+        self.arrays = {self.beams: [self.beam_arr], self.bombs: [self.bomb_arr, self.effects]}
+        for group, arrs in self.arrays.items():
+            arrs[:] = [arr for arr in arrs if arr is not None]
+
+        self.tmr = 0
+        self.state = GameState()
+        self.judge = False  # チャージしているか判定する。初期値False
+        self.c_tmr = 0  # チャージのタイマー
+        self.grid = SpatialHash()
+        self.quality = 0  # 見た目の質を下げるレベル（QualityGovernorを参照）
+        self.lerp = True  # 位置を補間して描くか
+        self.draw_every = 1  # 何フレームに一度描くか
+        self.set_quality(0)
+
+        self.waves = WaveScheduler.load(waves) if waves is not None else WaveScheduler(DEFAULT_WAVES)
+        self.waves.spawn(self) # 敵の呼び出し
+
+    def set_quality(self, level: int):
+        """
+        見た目だけの処理の質をレベルに合わせる（ゲームの進行には影響しない）
+        引数 level：0（全て）から3（最も軽い）まで
+        """
+        self.quality = level
+        self.effects.animate = level < 1
+        self.effects.draw_cap = None if level < 1 else 32
+        self.flip_every = 1 if level < 1 else 4  # 回復アイテムの反転の間引き
+        self.lerp = level < 2
+        self.hud.every = 1 if level < 2 else 5
+        self.draw_every = 1 if level < 3 else 2
+
+    def spawn(self, group: pg.sprite.Group, sprite: "pg.sprite.DirtySprite|None"):
+        """
+        スプライトをグループに追加する（dirty描画時はLayeredDirtyにも追加する）
+        プールが上限で生成されなかった（None）ときは何もしない
+        """
+        if sprite is None:
             return
+        group.add(sprite)
+        if self.layered is not None:
+            self.layered.add(sprite, layer=self.layers[group])
+
+    def step(self, inputs: Inputs) -> str:
+        """
+        1フレーム分ゲームを進める（描画はしない）
+        引数 inputs：そのフレームの入力
+        戻り値：ステップ後のゲームの状態（GameStateの状態名）
+        """
+        state = self.state
+        bird = self.bird
+        score = self.score
+        grid = self.grid
+        pools = self.pools
+        prof = self.prof
+        tel = self.tel
+        tel.frame = self.tmr
+        if state.state not in ("play", "hitstop"):  # 終了演出の間はタイマーだけ進める
+            state.tick()
+            return state.state
+
+        for space in inputs.space:
+            if space == "down": # スペースを押したら
+                self.judge = True
+                self.c_tmr = 0  # チャージのタイマーを定義。初期値0
+            if space == "up":  # スペースを離したら
+                if self.c_tmr >= 60:  # 60以上なら
+                    c_beam = pools[Chargebeam].acquire(bird, self.c_tmr)
+                    self.spawn(self.c_beams, c_beam)  # Chargebeamクラスに送る
+                    tel.emit("shot", kind="charge", charge=self.c_tmr, fired=c_beam is not None)
+                elif self.beam_arr is not None:
+                    vx = bird.dire[0]
+                    dropped = self.beam_arr.dropped
+                    self.beam_arr.spawn((bird.rect.centerx+bird.rect.width*vx, bird.rect.centery), (10*vx, 0), 0 if vx > 0 else 1)
+                    tel.emit("shot", kind="beam", charge=self.c_tmr, fired=self.beam_arr.dropped == dropped)
+                else:
+                    beam = pools[Beam].acquire(bird, 0)
+                    self.spawn(self.beams, beam)  # Beamクラスに送る
+                    tel.emit("shot", kind="beam", charge=self.c_tmr, fired=beam is not None)
+                self.judge = False
+        prof.lap("input")
 
-        if judge:  # judgeがTrueなら
-            c_tmr += 1  # チャージのタイマーをカウントし、Chargejudgeクラスのvalueに送る
-            c_judge.value = c_tmr
+        if state.state == "hitstop":  # 一時停止中は入力だけ受け付けてタイマーを進める
+            state.tick()
+            return state.state
+
+        if len(self.emys) == 0 and self.waves.done:  # 全ての敵が出現し終わって倒したらクリア
+            bird.change_img(9) # こうかとん悲しみエフェクト
+            state.enter("clear")
+            tel.emit("end", status="clear", score=score.value, hp=bird.hp)
+            return state.state
+
+        if self.judge:  # judgeがTrueなら
+            self.c_tmr += 1  # チャージのタイマーをカウントし、Chargejudgeクラスのvalueに送る
+            self.c_judge.value = self.c_tmr
         else:
-            c_judge.value = 0
+            self.c_judge.value = 0
 
-        if tmr%100 == 0:  # 100フレームに一回乱数を発生させる
-            r_num = random.randint(1, 5)
+        if self.tmr%100 == 0:  # 100フレームに一回乱数を発生させる
+            r_num = self.rng.randint(1, 5)
             if r_num == 1:  # 1/5の確率でアイテムを出現させる
-                healitems.add(HealItem())
+                self.spawn(self.healitems, HealItem(self.rng, self.view if self.stage is not None else None))
 
-        for emy in emys:
-            if tmr%30 == 0 and emy.state != "down":
-                # 敵機が停止状態に入ったら，intervalに応じて爆弾投下
-                bombs.add(Bomb(emy, bird))
-            
-        for emy in pg.sprite.spritecollide(bird, emys, False):
-            if bird.state != "invincible":
+        self.waves.spawn(self)  # ステージ定義に従って敵を出現させる
+        self.waves.fire(self)  # 敵機が停止状態に入ったら，intervalに応じて爆弾投下
+        prof.lap("spawn")
+
+        # 衝突判定の索引をフレームに一度だけ作り直す
+        grid.rebuild(emys=self.emys, beams=self.beams, c_beams=self.c_beams, bombs=self.bombs, healitems=self.healitems)
+        prof.lap("grid")
+
+        for emy in grid.spritecollide(bird, "emys", False):
+            if state.invincible <= 0:  # 無敵時間中はダメージを受けない
                 bird.hp -= 10
-                bird.change_img(4, screen)  # こうかとんダメージリアクション 
-                bird.state = "invincible"
-                i_tmr = 60
+                bird.change_img(4)  # こうかとんダメージリアクション
+                state.make_invincible(60)
+                tel.emit("damage", source=type(emy).__name__.lower(), amount=10, hp=bird.hp)
 
             if bird.hp <= 0:
-                bird.change_img(8, screen) # こうかとん悲しみエフェクト
-                pg.display.update()
-                time.sleep(2)
-                return
-            
-        i_tmr -= 1
-        if i_tmr < 0:
-            bird.state = "normal"
+                bird.change_img(8) # こうかとん悲しみエフェクト
+                state.enter("over")
+                tel.emit("end", status="over", score=score.value, hp=bird.hp)
+                return state.state
 
-        for emy in pg.sprite.groupcollide(emys, beams, False, True).keys():
-            exps.add(Explosion(emy, 100))  # 爆発エフェクト
+        state.tick()
+        prof.lap("hit:bird-emy")
+
+        for emy, beams in grid.groupcollide(self.emys, "beams", False, True).items():
+            self.effects.add(emy, 100)  # 爆発エフェクト
             score.value += 10  # 10点アップ
             emy.hp -= 1
-            bird.change_img(6, screen)  # こうかとん喜びエフェクト
+            bird.change_img(6)  # こうかとん喜びエフェクト
+            tel.emit("hit", target=type(emy).__name__.lower(), by="beam", shots=len(beams), hp=emy.hp)
+        if self.beam_arr is not None:
+            for emy in self.emys:
+                if len(idx := self.beam_arr.hits(emy.rect)) != 0:
+                    self.beam_arr.remove(idx)
+                    self.effects.add(emy, 100)  # 爆発エフェクト
+                    score.value += 10  # 10点アップ
+                    emy.hp -= 1
+                    bird.change_img(6)  # こうかとん喜びエフェクト
+                    tel.emit("hit", target=type(emy).__name__.lower(), by="beam", shots=len(idx), hp=emy.hp)
+        prof.lap("hit:emy-beam")
 
-        for emy in pg.sprite.groupcollide(emys, c_beams, False, True).keys():  # 敵とチャージビームの衝突
-            exps.add(Explosion(emy, 100))  # 爆発エフェクト
+        for emy, c_beams in grid.groupcollide(self.emys, "c_beams", False, True).items():  # 敵とチャージビームの衝突
+            self.effects.add(emy, 100)  # 爆発エフェクト
             score.value += 10  # 10点アップ
             emy.hp -= 5
-            bird.change_img(6, screen)  # こうかとん喜びエフェクト
+            bird.change_img(6)  # こうかとん喜びエフェクト
+            tel.emit("hit", target=type(emy).__name__.lower(), by="charge", shots=len(c_beams), hp=emy.hp)
+        prof.lap("hit:emy-cbeam")
 
-        for bomb in pg.sprite.groupcollide(bombs, beams, True, True).keys():
-            exps.add(Explosion(bomb, 50))  # 爆発エフェクト
+        for bomb in grid.groupcollide(self.bombs, "beams", True, True).keys():
+            self.effects.add(bomb, 50)  # 爆発エフェクト
             score.value += 1  # 1点アップ
+            tel.emit("hit", target="bomb", by="beam")
+        if self.bomb_arr is not None:
+            hit_bombs, hit_beams = self.bomb_arr.pair_hits(self.beam_arr)
+            for center in self.bomb_arr.centers(hit_bombs):
+                self.effects.add(center, 50)  # 爆発エフェクト
+                score.value += 1  # 1点アップ
+                tel.emit("hit", target="bomb", by="beam")
+            self.bomb_arr.remove(hit_bombs)
+            self.beam_arr.remove(hit_beams)
+        prof.lap("hit:bomb-beam")
 
-        for bomb in pg.sprite.groupcollide(bombs, c_beams, True, False).keys():  # 爆弾とチャージビームの衝突。チャージビームは衝突時に消えない
-            exps.add(Explosion(bomb, 50))  # 爆発エフェクト
+        for bomb in grid.groupcollide(self.bombs, "c_beams", True, False).keys():  # 爆弾とチャージビームの衝突。チャージビームは衝突時に消えない
+            self.effects.add(bomb, 50)  # 爆発エフェクト
             score.value += 1  # 1点アップ
+            tel.emit("hit", target="bomb", by="charge")
+        if self.bomb_arr is not None:
+            for c_beam in self.c_beams:
+                idx = self.bomb_arr.hits(c_beam.rect)
+                for center in self.bomb_arr.centers(idx):
+                    self.effects.add(center, 50)  # 爆発エフェクト
+                    score.value += 1  # 1点アップ
+                    tel.emit("hit", target="bomb", by="charge")
+                self.bomb_arr.remove(idx)
+        prof.lap("hit:bomb-cbeam")
 
-        if len(pg.sprite.spritecollide(bird, bombs, True)) != 0:
-            score.update(screen)
-            bird.change_img(4, screen)  # こうかとんダメージリアクション 
+        hit = len(grid.spritecollide(bird, "bombs", True)) != 0
+        if self.bomb_arr is not None and len(idx := self.bomb_arr.hits(bird.rect)) != 0:
+            self.bomb_arr.remove(idx)
+            hit = True
+        if hit:
+            bird.change_img(4)  # こうかとんダメージリアクション
             bird.hp -= 10
+            tel.emit("damage", source="bomb", amount=10, hp=bird.hp)
             if bird.hp <= 0:
-                bird.change_img(8, screen) # こうかとん悲しみエフェクト
-                pg.display.update()
-                time.sleep(2)
-                return
-        
-        elif len(pg.sprite.spritecollide(bird, healitems, False)) != 0:  # アイテムとこうかとんとの衝突判定
-            bird.change_img(6, screen)  # こうかとん喜びエフェクト
-            for item in pg.sprite.spritecollide(bird, healitems, True):
+                bird.change_img(8) # こうかとん悲しみエフェクト
+                state.enter("over")
+                tel.emit("end", status="over", score=score.value, hp=bird.hp)
+                return state.state
+
+        elif len(items := grid.spritecollide(bird, "healitems", True)) != 0:  # アイテムとこうかとんとの衝突判定
+            bird.change_img(6)  # こうかとん喜びエフェクト
+            for item in items:
+                hp = bird.hp
                 item.heal(bird)
-            
+                tel.emit("heal", amount=bird.hp-hp, hp=bird.hp)
+            state.enter("hitstop")  # 少しだけ止める演出
+        prof.lap("hit:bird")
+
+        bird.update(inputs.pressed, stage=self.stage)
+        if self.stage is not None:  # カメラをこうかとんに追従させ，敵はカメラと一緒に動かす
+            cam = min(max(bird.rect.centerx-WIDTH//2, 0), self.stage.width-WIDTH)
+            for emy in self.emys:
+                if isinstance(emy, Boss):
+                    emy.rect.x += cam-self.cam
+            self.cam = self.view.x = cam
+        view = self.view
+        prof.lap("upd:bird")
+        self.beams.update(view)
+        if self.beam_arr is not None:
+            self.beam_arr.update(view)
+        prof.lap("upd:beams")
+        self.c_beams.update(view)
+        prof.lap("upd:c_beams")
+        self.waves.update(self, view)
+        prof.lap("upd:emys")
+        self.bombs.update(view)
+        if self.bomb_arr is not None:
+            self.bomb_arr.update(view)
+        prof.lap("upd:bombs")
+        self.effects.update()
+        prof.lap("upd:exps")
+        self.healitems.update(self.stage, view, self.flip_every)  # 回復アイテムの位置更新（カメラから離れたものは消す）
+        prof.lap("upd:items")
+        if self.tmr%SIM_FPS == 0:  # 1秒ごとにボスのHPとスコアを記録する
+            tel.emit("status", score=score.value, hp=bird.hp,
+                     boss_hp=[emy.hp for emy in self.emys if isinstance(emy, Boss)], enemies=len(self.emys))
+        if self.stage is not None:
+            self.hit_terrain()
+            prof.lap("hit:terrain")
+        self.tmr += 1
+        return state.state
+
+    def hit_terrain(self):
+        """
+        地形に当たった爆弾と通常ビームを消す（爆弾は爆発させる，チャージビームは地形を貫通する）
+        """
+        stage = self.stage
+        for bomb in stage.spritecollide(self.bombs):
+            self.effects.add(bomb, 50)
+            bomb.kill()
+        for beam in stage.spritecollide(self.beams):
+            beam.kill()
+        if self.bomb_arr is not None:
+            idx = stage.array_hits(self.bomb_arr)
+            for center in self.bomb_arr.centers(idx):
+                self.effects.add(center, 50)
+            self.bomb_arr.remove(idx)
+            self.beam_arr.remove(stage.array_hits(self.beam_arr))
+
+    def counts(self) -> dict[str, int]:
+        """
+        グループごとのスプライト数を返す
+        """
+        return {
+            "beams": len(self.beams)+len(self.beam_arr or ()), "c_beams": len(self.c_beams), "emys": len(self.emys),
+            "bombs": len(self.bombs)+len(self.bomb_arr or ()), "exps": len(self.effects), "items": len(self.healitems),
+            "culled": self.waves.culled,
+        }
+
+    def snapshot(self):
+        """
+        step前の各スプライトの位置を記録する（補間描画用）
+        """
+        prev = self.prev
+        prev.clear()
+        self.prev_cam = self.cam
+        prev[self.bird] = self.bird.rect.topleft
+        for group in self.layers:
+            for sprite in group:
+                prev[sprite] = sprite.rect.topleft
+
+    def _lerp_blits(self, sprites, alpha: float, cam_x: float = 0) -> list[tuple[pg.Surface, tuple[float, float]]]:
+        """
+        直前のstepの位置と今の位置をalphaで補間した描画位置のblitsリストを作る（alphaが1.0なら今の位置）
+        記録のないスプライトや大きく飛んだスプライト（プールで再利用されたものなど）は今の位置に描く
+        cam_xはカメラの左端のx座標で，その分だけ左にずらして描く
+        """
+        prev = self.prev
+        blits = []
+        for sprite in sprites:
+            x, y = sprite.rect.topleft
+            p = prev.get(sprite)
+            if alpha < 1.0 and p is not None and abs(x-p[0]) < 100 and abs(y-p[1]) < 100:
+                x, y = p[0]+(x-p[0])*alpha, p[1]+(y-p[1])*alpha
+            blits.append((sprite.image, (x-cam_x, y)))
+        return blits
+
+    def draw(self, screen: pg.Surface, alpha: float = 1.0):
+        """
+        現在の状態を画面に描画し，ディスプレイに転送する
+        引数1 screen：画面Surface
+        引数2 alpha：直前のstepから次のstepまでの経過割合（1.0未満なら位置を補間して描く，dirty描画では無視）
+        """
+        layered = self.layered
+        prof = self.prof
+        prof.lap("other")
+        if layered is None:
+            cam_x = 0
+            if self.stage is not None:
+                cam_x = round(self.prev_cam+(self.cam-self.prev_cam)*min(alpha, 1.0))
+            self.bg.draw(screen, cam_x)
+            prof.lap("draw:bg")
+            if self.stage is not None:
+                self.stage.draw(screen, cam_x)
+                prof.lap("draw:terrain")
+            # 全スプライトを重ね順に1つのblitsリストにまとめて描く（配列版の弾はその重ねの位置で割り込む）
+            blits = self._lerp_blits([self.bird], alpha, cam_x)
+            for group in self.layers:
+                sprites = [emy for emy in group if emy.visible] if group is self.emys else group  # カメラから遠い雑魚敵は描かない
+                blits += self._lerp_blits(sprites, alpha, cam_x)
+                if arrs := self.arrays.get(group):
+                    screen.blits(blits, doreturn=False)
+                    blits = []
+                    for arr in arrs:
+                        arr.draw(screen, alpha, cam_x=cam_x)
+            screen.blits(blits, doreturn=False)
+            prof.lap("draw:sprites")
+            self.hud.update(screen)
+            prof.lap("hud")
+            prof.draw_overlay(screen)
+            prof.lap("overlay")
+            pg.display.update()
+            prof.lap("display")
+            return
+
+        if self.full_redraw:
+            layered.clear(screen, self.bg.surf)
+            self.bg.draw(screen)
+            layered.repaint_rect(screen.get_rect())
+            prof.lap("draw:bg")
+        for rct in self.hud_rcts:  # 前フレームのHUDの下を背景に戻す
+            layered.repaint_rect(rct)
+        rcts = layered.draw(screen)
+        prof.lap("draw:dirty")
+        arr_rcts = []
+        for arrs in self.arrays.values():  # 配列版の弾と爆発はスプライトの上にまとめて描く
+            for arr in arrs:
+                arr_rcts += arr.draw(screen, doreturn=True)
+        self.hud_rcts = arr_rcts+self.hud.update(screen)
+        prof.lap("hud")
+        if (rct := prof.draw_overlay(screen)) is not None:
+            self.hud_rcts.append(rct)
+        prof.lap("overlay")
+        rcts += self.hud_rcts
+        if self.full_redraw or len(rcts) > self.max_rects:
             pg.display.update()
-            time.sleep(0.1)  # 0.1秒停止
-
-        bird.update(key_lst, screen)
-        beams.update()
-        beams.draw(screen)
-        c_beams.update()
-        c_beams.draw(screen)
-        emys.update()
-        emys.draw(screen)
-        bombs.update()
-        bombs.draw(screen)
-        exps.update()
-        exps.draw(screen)
-        score.update(screen)
-        c_judge.update(screen)
-        healitems.update()  # 回復アイテムの位置更新
-        healitems.draw(screen)  # 回復アイテムの描画
-        hpbar.update(screen)
+        else:
+            pg.display.update(rcts)
+        prof.lap("display")
+        self.full_redraw = len(rcts) > self.max_rects  # 変化が多すぎるときは全画面描画に切り替える
+
+
+def autoplay(game: Game, frame: int) -> Inputs:
+    """
+    負荷試験用の簡単な自動操作
+    左右に往復しながらジャンプし，8フレームごとにビーム，200フレームごとにチャージショットを撃つ
+    """
+    right = frame//100%2 == 0
+    space = ()
+    if frame%200 == 100:
+        space = ("down",)  # チャージ開始
+    elif frame%200 == 170:
+        space = ("up",)  # チャージショット
+    elif frame%200 < 100 and frame%8 == 0:
+        space = ("down", "up")  # 通常のビーム
+    return Inputs({pg.K_RIGHT: right, pg.K_LEFT: not right, pg.K_UP: frame%50 == 0}, space)
+
+
+def run_headless(frames: int, policy=autoplay, render: bool = False, soa: bool = False,
+                 seed: int | None = None, stage: str | None = None, waves: str | None = None) -> dict[str, float]:
+    """
+    ウィンドウなし（SDLのdummyドライバ）でフレーム上限なしにゲームを回し，速度を測る
+    ゲームオーバーやクリアになったら新しいゲームを始めて続ける
+    引数1 frames：回すフレーム数
+    引数2 policy：(game, frame)を受け取りInputsを返す関数
+    引数3 render：Trueなら描画も行う（画面には出ない）
+    引数4 soa：Trueなら爆弾と通常ビームを配列版で扱う
+    引数5 seed：最初のゲームの乱数のシード（次のゲームからは1ずつ増やす）
+    引数6 stage：地形のステージファイル
+    引数7 waves：敵の出現を定義したJSONファイル
+    戻り値：フレーム数，経過秒数，1秒あたりのフレーム数などの辞書
+    """
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    pg.init()
+    screen = pg.display.set_mode((WIDTH, HEIGHT))
+    game = Game(soa=soa, seed=seed, stage=stage, waves=waves)
+    games = 1
+    start = time.perf_counter()
+    for frame in range(frames):
+        status = game.step(policy(game, frame))
+        if render:
+            game.draw(screen)
+        if status not in ("play", "hitstop"):  # 終了演出は飛ばして次のゲームへ
+            game = Game(soa=soa, seed=None if seed is None else seed+games, stage=stage, waves=waves)
+            games += 1
+    elapsed = time.perf_counter()-start
+    return {"frames": frames, "seconds": elapsed, "fps": frames/elapsed if elapsed > 0 else float("inf"), "games": games}
+
+
+def run_replay(path: str, render: bool = False, soa: bool = False, stage: str | None = None,
+               waves: str | None = None) -> dict[str, int]:
+    """
+    記録した入力をウィンドウなしでフレーム上限なしに再生し，最終的な結果を返す
+    シードと入力が同じなら，記録したときと同じ展開になる
+    引数1 path：InputRecorderで記録したファイル
+    引数2 render：Trueなら描画も行う（画面には出ない）
+    引数3 soa：Trueなら爆弾と通常ビームを配列版で扱う（記録時と違えばValueError）
+    引数4 stage：地形のステージファイル（記録時と内容が違えばValueError）
+    引数5 waves：敵の出現を定義したJSONファイル（記録時と内容が違えばValueError）
+    戻り値：再生したフレーム数，最終スコア，こうかとんのHP，終了時の状態の辞書
+    """
+    player = InputPlayer(path)
+    player.check(soa, stage, waves)
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    pg.init()
+    screen = pg.display.set_mode((WIDTH, HEIGHT))
+    game = Game(soa=soa, seed=player.seed, stage=stage, waves=waves)
+    status = "play"
+    for frame, inputs in enumerate(player.frames):
+        status = game.step(inputs)
+        if render:
+            game.draw(screen)
+        if status == "done":
+            break
+    return {"frames": frame+1 if player.frames else 0, "score": game.score.value, "hp": game.bird.hp,
+            "status": status, "seed": player.seed}
+
+
+def loading(screen: pg.Surface, paths: list[str]) -> float:
+    """
+    画像ファイルを別スレッドでデコードしている間，読み込み画面（進み具合のバー）を表示する
+    引数1 screen：画面Surface
+    引数2 paths：デコードする画像ファイルのパスのリスト
+    戻り値：かかった秒数
+    """
+    t0 = time.perf_counter()
+    futures = ASSETS.prefetch(paths)
+    font = pg.font.Font(None, 50)
+    bar = pg.Rect(0, 0, 400, 20)
+    bar.center = WIDTH//2, HEIGHT//2+20
+    while True:
+        done = sum(future.done() for future in futures)
+        pg.event.pump()  # 閉じるボタンなどのイベントはゲーム開始後に処理する
+        screen.fill((0, 0, 0))
+        txt = font.render(f"Loading... {done}/{len(futures)}", True, (255, 255, 255))
+        screen.blit(txt, txt.get_rect(center=(WIDTH//2, HEIGHT//2-30)))
+        pg.draw.rect(screen, (255, 255, 255), bar, 2)
+        pg.draw.rect(screen, (255, 255, 255), (bar.x, bar.y, bar.w*done//max(len(futures), 1), bar.h))
         pg.display.update()
-        tmr += 1
-        clock.tick(50)
+        if done == len(futures):
+            return time.perf_counter()-t0
+        # 残りのどれかが終わるか，一定時間ごとに描き直す
+        wait([future for future in futures if not future.done()], timeout=1/30, return_when=FIRST_COMPLETED)
+
+
+def main(dirty: bool = False, max_rects: int = 60, fps: int = 0, profile: str | None = None, soa: bool = False,
+         seed: int | None = None, record: str | None = None, replay: str | None = None, stage: str | None = None,
+         waves: str | None = None, quality: int | None = None, telemetry: str | None = None):
+    """
+    ゲームのメインループ
+    シミュレーションはSIM_FPSの固定間隔で進め，描画はfpsを上限に行い，
+    その間の位置は補間して描く
+    引数1 dirty：Trueなら変化した矩形だけを描き直して転送する（LayeredDirtyによる描画）
+    引数2 max_rects：1フレームの変化矩形がこれを超えたら，次のフレームは画面全体を描き直す
+    引数3 fps：描画の上限fps（0なら60，pygame-ceではディスプレイのリフレッシュレート）
+    引数4 profile：処理時間の計測結果を終了時に書き出すファイル（.csvまたは.json）
+    引数5 soa：Trueなら爆弾と通常ビームを配列版で扱う
+    引数6 seed：乱数のシード（Noneならランダム）
+    引数7 record：stepごとの入力を記録するファイル
+    引数8 replay：記録した入力を再生するファイル（シードも記録のものを使い，キー入力は無視する，
+        soa，stage，wavesが記録時と違えばValueError）
+    引数9 stage：地形のステージファイル（Noneなら地形なしの1画面）
+    引数10 waves：敵の出現を定義したJSONファイル（Noneならボス1体）
+    引数11 quality：見た目の質のレベルを固定する（Noneなら処理時間に応じて自動で変える）
+    引数12 telemetry：プレイの記録（撃った・当てた・被弾などのイベントと1秒ごとの処理時間）を書き出すファイル
+    F3キーで計測結果のオーバーレイを表示／非表示する
+    起動時は画像を別スレッドでデコードしながら読み込み画面を出し，最初のフレームまでの時間を記録する
+    """
+    pg.display.set_caption("真！こうかとん無双")
+    screen = pg.display.set_mode((WIDTH, HEIGHT))
+    startup = {"loading_ms": loading(screen, ASSETS.startup_paths(ATLAS, PRELOAD))*1000}
+    if fps <= 0:  # リフレッシュレートを取れるのはpygame-ceのみなので，取れなければ60
+        refresh_rate = getattr(pg.display, "get_current_refresh_rate", None)
+        fps = (refresh_rate() if refresh_rate is not None else 0) or 60
+    prof = FrameProfiler(max_rows=200000 if profile else 0)
+    player = InputPlayer(replay) if replay else None
+    if player is not None:
+        player.check(soa, stage, waves)
+        seed = player.seed
+    tel = Telemetry(telemetry)
+    game = Game(dirty, max_rects, prof, soa, seed, stage, waves, tel)
+    recorder = InputRecorder(record, game.seed, soa, stage, waves) if record else None
+    governor = QualityGovernor(1000/fps, fixed=quality)
+    game.set_quality(governor.level)
+    tel.emit("session", seed=game.seed, stage=stage, waves=waves, soa=soa, fps=fps, replay=replay)
+    try:
+        return _loop(game, screen, fps, prof, recorder, player, startup, governor)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        tel.close()
+        if profile:
+            print(", ".join(f"{name} {ms:.0f} ms" for name, ms in startup.items()))
+            prof.dump(profile, {
+                "startup": startup,
+                "quality": governor.log,
+                "pools": {cls.__name__: pool.stats() for cls, pool in game.pools.items()},
+                "assets": ASSETS.stats(),
+                "effects": game.effects.stats(),
+                "background": game.bg.stats(),
+                **({"stage": game.stage.stats()} if game.stage is not None else {}),
+            })
+
+
+def _loop(game: Game, screen: pg.Surface, fps: int, prof: FrameProfiler,
+          recorder: InputRecorder | None = None, player: InputPlayer | None = None, startup: dict | None = None,
+          governor: QualityGovernor | None = None):
+    """
+    固定間隔のシミュレーションと補間描画を行うメインループの本体
+    recorderがあればstepごとの入力を記録し，playerがあればキー入力の代わりに記録を再生する
+    startupには最初のフレームを描いて画面に出すまでの起動からの時間（first_frame_ms）を入れ，game.telにも記録する
+    最初のフレームを描いたら，LAZYの画像を別スレッドで読み始める
+    governorがあれば，フレームごとの処理時間を渡して見た目の質のレベルを調整させる
+    game.telに1秒ごとの描画回数と処理時間（平均・最大），見た目の質の変更を記録する
+    """
+    clock = pg.time.Clock()
+    dt = 1/SIM_FPS
+    acc = 0.0  # まだシミュレーションしていない経過時間（秒）
+    space: list[str] = []  # まだstepに渡していないスペースキーのイベント
+    played = 0  # 再生したstep数
+    frame = 0  # 描画ループの回数
+    tel = game.tel
+    work_sum = work_max = 0.0  # 記録していない間の処理時間（ミリ秒）
+    t_tel = time.perf_counter()
+    f_tel = 0
+
+    while True:
+        prof.begin_frame()
+        inputs = Inputs.poll()
+        if inputs.quit:
+            return 0
+        if inputs.overlay:
+            prof.visible = not prof.visible
+        space += inputs.space
+        prof.lap("events")
+        acc += clock.tick(fps)/1000
+        t_work = time.perf_counter()
+        prof.lap("wait")
+        steps = 0
+        while acc >= dt and steps < MAX_STEPS:
+            game.snapshot()
+            prof.lap("snapshot")
+            if player is not None:
+                step_inputs = player.policy(game, played)
+                played += 1
+            else:
+                step_inputs = Inputs(inputs.pressed, tuple(space))
+            if recorder is not None:
+                recorder.record(step_inputs)
+            if game.step(step_inputs) == "done":  # 終了演出が終わったら
+                return
+            space.clear()  # イベントは最初のstepでだけ処理する
+            acc -= dt
+            steps += 1
+        if steps == MAX_STEPS:
+            acc = min(acc, dt)  # 追いつけない分は捨てる（処理落ちの悪循環を防ぐ）
+        frame += 1
+        if frame%game.draw_every == 0:
+            game.draw(screen, acc/dt if game.lerp else 1.0)
+            if startup is not None and "first_frame_ms" not in startup:  # 実際に画面へ出した最初のフレーム
+                startup["first_frame_ms"] = (time.perf_counter()-START)*1000
+                tel.emit("startup", **startup)
+                ASSETS.prefetch(LAZY)
+        work = (time.perf_counter()-t_work)*1000
+        if governor is not None:
+            if governor.observe(work, steps == MAX_STEPS):
+                game.set_quality(governor.level)
+                tel.emit("quality", level=governor.level)
+        if tel.enabled:
+            work_sum += work
+            work_max = max(work_max, work)
+            if (now := time.perf_counter())-t_tel >= 1:
+                n = frame-f_tel
+                tel.emit("frames", fps=round(n/(now-t_tel), 1), work_ms=round(work_sum/n, 2), work_max_ms=round(work_max, 2),
+                         buffered=len(tel.buf), dropped=tel.dropped)
+                work_sum = work_max = 0.0
+                t_tel, f_tel = now, frame
+        prof.end_frame(game.counts())
+
+def seed_arg(text: str) -> int:
+    """
+    --seedの値を確かめる（記録ファイルに入れられる0以上2**64未満の整数）
+    """
+    seed = int(text)
+    if not 0 <= seed < 2**64:
+        raise argparse.ArgumentTypeError("シードは0以上2**64未満の整数にしてください")
+    return seed
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="真！こうかとん無双")
+    parser.add_argument("--dirty", action="store_true", help="変化した矩形だけを描き直す描画モード")
+    parser.add_argument("--max-rects", type=int, default=60, help="全画面描画に切り替える変化矩形の数")
+    parser.add_argument("--headless", type=int, metavar="N", help="ウィンドウなしでNフレームを上限なしに回し，速度を表示する")
+    parser.add_argument("--render", action="store_true", help="--headless時も描画処理を行う")
+    parser.add_argument("--fps", type=int, default=0, help="描画の上限fps（0なら60，pygame-ceではディスプレイのリフレッシュレート）。120Hzなどの画面では指定する")
+    parser.add_argument("--profile", metavar="PATH", help="処理時間の計測結果を終了時に書き出す（.csvまたは.json）")
+    parser.add_argument("--soa", action="store_true", help="爆弾と通常ビームをNumPy配列でまとめて処理する（要NumPy）")
+    parser.add_argument("--build-atlas", action="store_true", help=f"スプライト画像と変形画像を{ATLAS}に詰めて終了する")
+    parser.add_argument("--stage", metavar="PATH", help="地形のあるスクロールステージを遊ぶ（例：stage/stage1.txt）")
+    parser.add_argument("--waves", metavar="PATH", help="敵の出現を定義したJSONファイル（例：stage/waves1.json）")
+    parser.add_argument("--quality", type=int, choices=range(QualityGovernor.max_level+1),
+                        help="見た目の質のレベルを固定する（0：全て〜3：最も軽い，省略時は処理時間に応じて自動）")
+    parser.add_argument("--seed", type=seed_arg, help="乱数のシード（同じシードと入力なら同じ展開になる）")
+    parser.add_argument("--record", metavar="PATH", help="stepごとの入力をファイルに記録する")
+    parser.add_argument("--replay", metavar="PATH", help="記録した入力を再生する")
+    parser.add_argument("--fast", action="store_true", help="--replay時にウィンドウなしで早送りし，結果だけを表示する")
+    parser.add_argument("--telemetry", metavar="PATH", help="プレイのイベントと処理時間をJSON Lines（.gzなら圧縮）で書き出す")
+    args = parser.parse_args()
+    if args.soa and np is None:
+        parser.error("--soa にはNumPyが必要です")
+    if args.build_atlas:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        pg.init()
+        pg.display.set_mode((WIDTH, HEIGHT))
+        index = ASSETS.build_atlas(ATLAS, PRELOAD+LAZY, WARMUP)
+        print(f"{ATLAS}: {len(index['regions'])} images from {len(index['sources'])} files")
+        pg.quit()
+        sys.exit()
+    if args.replay:
+        try:
+            InputPlayer(args.replay).check(args.soa, args.stage, args.waves)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    if args.replay and args.fast:
+        result = run_replay(args.replay, args.render, args.soa, args.stage, args.waves)
+        print(f"seed {result['seed']}: {result['frames']} frames, score {result['score']}, "
+              f"hp {result['hp']} ({result['status']})")
+        pg.quit()
+        sys.exit()
+    if args.headless:
+        result = run_headless(args.headless, render=args.render, soa=args.soa, seed=args.seed, stage=args.stage, waves=args.waves)
+        print(f"{result['frames']} frames in {result['seconds']:.2f} s: {result['fps']:.1f} fps ({result['games']} games)")
+        pg.quit()
+        sys.exit()
     pg.init()
-    main()
+    main(args.dirty, args.max_rects, args.fps, args.profile, args.soa, args.seed, args.record, args.replay, args.stage, args.waves,
+         args.quality, args.telemetry)
     pg.quit() 
     sys.exit()
\ No newline at end of file